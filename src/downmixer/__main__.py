@@ -8,8 +8,11 @@ import time
 from pathlib import Path
 
 from downmixer import processing, log
+from downmixer.file_tools import Format
+from downmixer.processing.pipeline import PipelineProcessor
 from downmixer import providers
 from downmixer.providers import ResourceType
+from downmixer.providers.matches import MatchStore
 
 logger = logging.getLogger("downmixer").getChild(__name__)
 
@@ -28,6 +31,68 @@ parser.add_argument(
     type=int,
     help="Number of threads to use for parallel downloads.",
 )
+parser.add_argument(
+    "-f",
+    "--format",
+    default=[Format.MP3.value],
+    nargs="+",
+    metavar="FORMAT[:BITRATE]",
+    help="Formats of the final files, optionally with a bitrate (e.g. 'mp3:320k opus:160k'). Every format is "
+    "converted in the same FFmpeg run. Defaults to 'mp3'. Audio already in a codec the format can hold (like Opus "
+    "audio for 'opus') is copied instead of encoded again.",
+)
+parser.add_argument(
+    "-e",
+    "--max-encodes",
+    default=None,
+    type=int,
+    help="Maximum number of FFmpeg conversions running at the same time. Defaults to the number of CPU cores. With "
+    "--stream, also the maximum number of songs downloaded at the same time.",
+)
+parser.add_argument(
+    "-s",
+    "--sync",
+    action="store_true",
+    help="Keep a manifest in the output folder and skip songs that were already downloaded to it.",
+)
+parser.add_argument(
+    "-w",
+    "--watch",
+    default=None,
+    type=float,
+    metavar="INTERVAL",
+    help="Keep running and sync the playlist again every INTERVAL seconds, only processing songs added since the "
+    "last sync. Implies --sync.",
+)
+parser.add_argument(
+    "--prune",
+    action="store_true",
+    help="When syncing a playlist, delete the files of songs removed from it since the last sync. Needs --sync or "
+    "--watch.",
+)
+parser.add_argument(
+    "--stream",
+    action="store_true",
+    help="Convert songs while they're downloaded, without saving the download to a temporary file first.",
+)
+parser.add_argument(
+    "--embed-tags",
+    action="store_true",
+    help="Write metadata and cover art while converting, so tagging doesn't write the whole file again.",
+)
+parser.add_argument(
+    "-m",
+    "--match-store",
+    type=Path,
+    help="Path of a database of previous matches. Songs found in it aren't searched again, and new matches are saved "
+    "to it. Created if it doesn't exist.",
+)
+parser.add_argument(
+    "-p",
+    "--pipeline",
+    action="store_true",
+    help="Process playlists in stages (search, download, convert, lyrics, tag) with separate worker counts.",
+)
 parser.add_argument(
     "-o",
     "--output-folder",
@@ -81,7 +146,38 @@ parser.add_argument(
     default=None,
     help="Settings for the lyrics provider as a JSON string. See documentation for available options for each provider.",
 )
+
+
+def _parse_targets(values: list[str]) -> list[tuple[Format, str]]:
+    """Parses the values of `--format` into conversion targets, exiting with a usage error if any is invalid."""
+    targets = []
+    for value in values:
+        format_name, _, bitrate = value.partition(":")
+        try:
+            targets.append((Format(format_name), bitrate or "320k"))
+        except ValueError:
+            parser.error(
+                f"invalid format '{format_name}' (choose from {', '.join(x.value for x in Format)})"
+            )
+
+    formats = [x[0] for x in targets]
+    if len(set(formats)) != len(formats):
+        parser.error("each format can only be given once in --format")
+    return targets
+
+
 args = parser.parse_args()
+if args.prune and not args.sync and args.watch is None:
+    parser.error("--prune can only be used with --sync or --watch")
+output_targets = _parse_targets(args.format)
+
+
+async def _run(processor: processing.BasicProcessor, coro):
+    try:
+        return await coro
+    finally:
+        if processor.match_store is not None:
+            processor.match_store.close()
 
 
 def command_line():
@@ -125,7 +221,10 @@ def command_line():
                 else None
             )
 
-            processor = processing.BasicProcessor(
+            processor_class = (
+                PipelineProcessor if args.pipeline else processing.BasicProcessor
+            )
+            processor = processor_class(
                 selected_info_provider(ip_settings),
                 selected_audio_provider,
                 ap_settings,
@@ -133,6 +232,14 @@ def command_line():
                 args.output,
                 Path(temp),
                 args.threads,
+                max_encodes=args.max_encodes,
+                use_manifest=args.sync or args.watch is not None,
+                stream_downloads=args.stream,
+                output_targets=output_targets,
+                embed_tags=args.embed_tags,
+                match_store=(
+                    MatchStore(args.match_store) if args.match_store else None
+                ),
             )
 
             logger.debug(
@@ -149,13 +256,24 @@ def command_line():
             rtype = processor.info_provider.get_resource_type(args.id)
 
             start = time.time()
-            if rtype == ResourceType.SONG:
+            if args.watch is not None:
+                if rtype != ResourceType.PLAYLIST:
+                    raise ValueError("only playlists can be watched")
+                logger.info(f"Watching playlist every {args.watch} seconds")
+                asyncio.run(
+                    _run(processor, processor.watch([args.id], args.watch, args.prune))
+                )
+            elif rtype == ResourceType.SONG:
                 logger.info("Downloading one track")
-                asyncio.run(processor.process_song(args.id))
+                asyncio.run(_run(processor, processor.process_song(args.id)))
             else:
                 logger.info("Downloading many tracks")
                 loop = asyncio.new_event_loop()
-                loop.run_until_complete(processor.process_playlist(args.id))
+                if args.sync:
+                    coro = processor.sync_playlist(args.id, args.prune)
+                else:
+                    coro = processor.process_playlist(args.id)
+                loop.run_until_complete(_run(processor, coro))
                 loop.close()
 
             logger.info(f"Finished processing in {time.time() - start} seconds")
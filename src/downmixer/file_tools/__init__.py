@@ -1,5 +1,7 @@
 """Code relating to the manipulation of files - converting and tagging audio files specifically."""
 
+from __future__ import annotations
+
 from enum import Enum
 
 
@@ -8,6 +10,11 @@ class Format(Enum):
     FLAC = "flac"
     WAV = "wav"
     OPUS = "opus"
+    M4A = "m4a"
+
+    def can_copy(self, codec: AudioCodecs) -> bool:
+        """Checks if audio in the codec given can be put in this format as is, without being encoded again."""
+        return codec in _COPYABLE_CODECS.get(self, ())
 
 
 # TODO: Deal with the fact there's like 5000 different combinations of this
@@ -16,3 +23,10 @@ class AudioCodecs(Enum):
     MP4A_40_5 = "mp4a.40.5"
     MP4A_40_2 = "mp4a.40.2"
     OPUS = "opus"
+
+
+# Codecs that each format can hold without encoding the audio again
+_COPYABLE_CODECS = {
+    Format.OPUS: (AudioCodecs.OPUS,),
+    Format.M4A: (AudioCodecs.MP4A_40_2, AudioCodecs.MP4A_40_5),
+}
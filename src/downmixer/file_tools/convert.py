@@ -1,44 +1,187 @@
+from __future__ import annotations
+
+import asyncio
+import collections
+import contextlib
 import copy
 import logging
 import os
+import tempfile
+import time
+from dataclasses import dataclass
 from pathlib import Path
+from typing import Callable, Awaitable, Iterator
 
 from ffmpeg.asyncio import FFmpeg
 
 from downmixer.file_tools import Format
-from downmixer.providers import Download
+from downmixer.file_tools.tag import TagData
+from downmixer.providers import Download, AudioSearchResult, AudioStream
 
 logger = logging.getLogger("downmixer").getChild(__name__)
 
+# Formats FFmpeg can write the cover image into, as an attached picture
+_ATTACHED_PICTURE_FORMATS = (Format.MP3, Format.FLAC, Format.M4A)
+# Formats whose tags are before the audio data, so tags that don't fit in their padding move all of it. FLAC is left
+# out since FFmpeg already writes a padding block, M4A and WAV since FFmpeg writes their tags after the audio.
+_PADDED_FORMATS = (Format.MP3, Format.OPUS)
+# Space reserved in the tags written by FFmpeg, so tags can be edited later without rewriting the file
+TAG_RESERVE = 16 * 1024
+
+
+def _check_targets(targets: list[tuple[Format, str]]):
+    formats = [x[0] for x in targets]
+    if len(set(formats)) != len(formats):
+        raise ValueError("Each conversion target must have a different format")
+
+
+def _escape_ffmetadata(value: str) -> str:
+    for char in ("\\", "=", ";", "#", "\n"):
+        value = value.replace(char, "\\" + char)
+    return value
+
+
+def _make_ffmetadata(tags: TagData, reserve: int) -> str:
+    """Makes the contents of an FFmpeg metadata file with the tags given. A placeholder tag of `reserve` bytes is
+    added if it's not zero, which is later replaced by padding when the tags are edited.
+    """
+    metadata = {
+        "title": tags.title,
+        "artist": "; ".join(tags.artists),
+        "album": tags.album,
+        "album_artist": "; ".join(tags.album_artists or []),
+        "date": tags.date,
+        "isrc": tags.isrc,
+        "track": tags.track,
+        "lyrics": tags.lyrics,
+    }
+    if reserve > 0:
+        metadata["downmixer_reserved"] = " " * reserve
+
+    lines = [";FFMETADATA1"]
+    for key, value in metadata.items():
+        if value:
+            lines.append(f"{key}={_escape_ffmetadata(value)}")
+    return "\n".join(lines) + "\n"
+
 
 class Converter:
     def __init__(
-        self, download: Download, format: Format = Format.MP3, bitrate: str = "320k"
+        self,
+        download: Download,
+        format: Format = Format.MP3,
+        bitrate: str = "320k",
+        threads: int = None,
+        targets: list[tuple[Format, str]] = None,
+        tags: TagData = None,
     ):
         """Holds information for FFmpeg to convert a download. By default, uses MP3 output format and 320kbps bitrate.
+        If the download's codec can be put in the output format as is (like Opus audio to `Format.OPUS`), the audio
+        is copied to the new container instead of being encoded again.
+
+        Many formats can be made at once by giving `targets`, in which case FFmpeg decodes the download only once
+        and encodes it into every target in the same run.
+
+        If `tags` are given, FFmpeg writes them (and the cover image, in formats that can hold it) while converting,
+        leaving `TAG_RESERVE` bytes of room in the tags. `tag.write_tags` can then edit them in place, without
+        writing the whole file again.
 
         Args:
             download (Download): Download object to be converted.
             format (Format): Output format from the Format enum.
             bitrate (str): Bitrate in kbps as a string denoting value with a 'k' in the end. Passed directly into FFmpeg.
+            threads (int, optional): Amount of threads FFmpeg can use for the encode. Leaves it up to FFmpeg if None.
+            targets (list[tuple[Format, str]], optional): Formats and bitrates to convert to, each format only once.
+                Replaces `format` and `bitrate` if given.
+            tags (TagData, optional): Metadata written to the converted files.
         """
         self.download = download
-        self.format = format
-        self.bitrate = bitrate
+        self.targets = targets or [(format, bitrate)]
+        self.format, self.bitrate = self.targets[0]
+        self.threads = threads
+        self.tags = tags
+        _check_targets(self.targets)
 
-    async def convert(self, delete_original: bool = True) -> Download:
-        logger.info("Starting conversion")
+    def _output_options(self, format: Format, bitrate: str) -> dict:
+        if format.can_copy(self.download.audio_codec):
+            # The audio is already in a codec the format can hold, only change the container
+            logger.info(
+                f"Copying {self.download.audio_codec.value} audio to {format.value} without encoding"
+            )
+            return {"c:a": "copy"}
 
-        # TODO: Check if file already exists
-        output = str(self.download.filename).replace(
-            self.download.filename.suffix, "." + self.format.value
-        )
-        ffmpeg = (
-            FFmpeg()
-            .option("vn")
-            .input(str(self.download.filename))
-            .output(output, {"b:a": self.bitrate})
-        )
+        output_options = {"b:a": bitrate}
+        if self.threads is not None:
+            output_options["threads"] = self.threads
+        return output_options
+
+    def _tag_options(self, format: Format, has_cover: bool) -> dict:
+        # Inputs are the audio, the metadata file and the cover image, in that order
+        if has_cover and format in _ATTACHED_PICTURE_FORMATS:
+            return {
+                "map": ["0:a", "2:v"],
+                "map_metadata": 1,
+                "c:v": "copy",
+                "disposition:v": "attached_pic",
+            }
+        return {"map": "0:a", "map_metadata": 1}
+
+    def _tag_reserve(self) -> int:
+        reserve = 0
+        for format, _ in self.targets:
+            if format not in _PADDED_FORMATS:
+                continue
+            if self.tags.cover and format not in _ATTACHED_PICTURE_FORMATS:
+                # The cover is only added when the tags are edited, base64 encoded in a comment
+                reserve = max(reserve, TAG_RESERVE + len(self.tags.cover) * 4 // 3)
+            else:
+                reserve = max(reserve, TAG_RESERVE)
+        return reserve
+
+    @contextlib.contextmanager
+    def _tag_inputs(self) -> Iterator[list[Path]]:
+        """Writes the metadata file (and the cover image, if there's one) FFmpeg reads the tags from to a temporary
+        folder, and yields their paths. Yields an empty list if there are no tags."""
+        if self.tags is None:
+            yield []
+            return
+
+        with tempfile.TemporaryDirectory(prefix="downmixer-") as folder:
+            metadata = Path(folder).joinpath("metadata.txt")
+            metadata.write_text(
+                _make_ffmetadata(self.tags, self._tag_reserve()), encoding="utf-8"
+            )
+            if not self.tags.cover:
+                yield [metadata]
+                return
+
+            cover = Path(folder).joinpath("cover.jpg")
+            cover.write_bytes(self.tags.cover)
+            yield [metadata, cover]
+
+    def _output_paths(self, path: Path) -> list[Path]:
+        """Returns the path of each target, with the name of the path given and the extension of its format."""
+        return [path.with_name(f"{path.stem}.{x.value}") for x, _ in self.targets]
+
+    def _make_ffmpeg(
+        self,
+        input: str,
+        outputs: list[Path],
+        input_options: dict = None,
+        tag_inputs: list[Path] = None,
+    ) -> FFmpeg:
+        ffmpeg = FFmpeg().option("vn").input(input, input_options)
+        for tag_input in tag_inputs or []:
+            ffmpeg = ffmpeg.input(
+                str(tag_input),
+                {"f": "ffmetadata"} if tag_input.suffix == ".txt" else None,
+            )
+
+        for output, (format, bitrate) in zip(outputs, self.targets):
+            options = self._output_options(format, bitrate)
+            if tag_inputs:
+                options.update(self._tag_options(format, len(tag_inputs) > 1))
+            ffmpeg = ffmpeg.output(str(output), options)
 
         @ffmpeg.on("start")
         def on_start(arguments):
@@ -60,12 +203,311 @@ class Converter:
         def on_error(code):
             logger.error(f"ffmpeg error code {code}")
 
-        logger.info("Running ffmpeg")
-        await ffmpeg.execute()
-        if delete_original:
-            os.remove(self.download.filename)
+        return ffmpeg
+
+    def _make_downloads(self, outputs: list[Path]) -> list[Download]:
+        logger.debug("Creating copies of download object")
+        downloads = []
+        for output in outputs:
+            edited_download = copy.copy(self.download)
+            edited_download.filename = output
+            downloads.append(edited_download)
+        return downloads
+
+    async def convert(self, delete_original: bool = True) -> Download:
+        """Converts the download to the first target. Use `convert_all` to get every target."""
+        return (await self.convert_all(delete_original))[0]
+
+    async def convert_all(self, delete_original: bool = True) -> list[Download]:
+        """Converts the download to every target in a single FFmpeg run.
+
+        Args:
+            delete_original (bool): Whether the downloaded file is deleted after conversion.
+
+        Returns:
+            A download object for each target, in the same order as the targets.
+        """
+        logger.info("Starting conversion")
+
+        # TODO: Check if file already exists
+        outputs = self._output_paths(self.download.filename)
+        # FFmpeg can't write over the file it's reading (like an M4A download converted to M4A), so that target is
+        # written to another name and moved over the download once it's deleted
+        staged = [
+            (
+                x.with_name(f"{x.stem}.converting{x.suffix}")
+                if x == self.download.filename
+                else x
+            )
+            for x in outputs
+        ]
+        for output, staged_output in zip(outputs, staged):
+            if output != staged_output:
+                staged_output.unlink(missing_ok=True)
+
+        with self._tag_inputs() as tag_inputs:
+            ffmpeg = self._make_ffmpeg(
+                str(self.download.filename), staged, tag_inputs=tag_inputs
+            )
+
+            logger.info("Running ffmpeg")
+            try:
+                await ffmpeg.execute()
+            except BaseException:
+                for output, staged_output in zip(outputs, staged):
+                    if output != staged_output:
+                        staged_output.unlink(missing_ok=True)
+                raise
+
+        if not delete_original:
+            # The download is kept, so the target keeps its other name
+            return self._make_downloads(staged)
+
+        os.remove(self.download.filename)
+        for output, staged_output in zip(outputs, staged):
+            if output != staged_output:
+                os.replace(staged_output, output)
+
+        return self._make_downloads(outputs)
+
+    async def convert_stream(self, stream: AudioStream) -> list[Download]:
+        """Converts audio read from a stream as it's downloaded, to every target in a single FFmpeg run. The files
+        are named after the download's `filename`, and the source is never written to disk.
+
+        Args:
+            stream (AudioStream): Stream of the source audio, usually from `BaseAudioProvider.stream`.
+
+        Returns:
+            A download object for each target, in the same order as the targets.
+        """
+        logger.info("Starting streamed conversion")
+        outputs = self._output_paths(self.download.filename)
+        input_options = {"f": stream.container} if stream.container else None
+
+        reader = asyncio.StreamReader()
+
+        async def feed():
+            try:
+                async for chunk in stream.chunks:
+                    reader.feed_data(chunk)
+            except Exception as e:
+                # Makes FFmpeg stop reading, so the conversion fails with the same error
+                reader.set_exception(e)
+                raise
+            else:
+                reader.feed_eof()
+
+        with self._tag_inputs() as tag_inputs:
+            ffmpeg = self._make_ffmpeg("pipe:0", outputs, input_options, tag_inputs)
+            ffmpeg = ffmpeg.option("y")
+
+            feeder = asyncio.create_task(feed())
+            try:
+                logger.info("Running ffmpeg")
+                await ffmpeg.execute(reader)
+                await feeder
+            except BaseException:
+                if feeder.done() and not feeder.cancelled():
+                    # Already raised through FFmpeg, don't warn about it not being retrieved
+                    feeder.exception()
+                feeder.cancel()
+                for output in outputs:
+                    output.unlink(missing_ok=True)
+                raise
+
+        return self._make_downloads(outputs)
+
+
+@dataclass
+class EncodeStats:
+    """Throughput statistics of the encodes ran by a `ConversionScheduler`.
+
+    Attributes:
+        encodes (int): Amount of successful encodes.
+        failures (int): Amount of encodes that raised an exception.
+        audio_seconds (float): Total duration, in seconds, of the songs encoded.
+        busy_seconds (float): Total time spent running FFmpeg, summed over all concurrent encodes.
+        started (float, optional): Time (from `time.monotonic`) when the first encode started.
+        finished (float, optional): Time (from `time.monotonic`) when the last encode finished.
+    """
+
+    encodes: int = 0
+    failures: int = 0
+    audio_seconds: float = 0.0
+    busy_seconds: float = 0.0
+    started: float | None = None
+    finished: float | None = None
+
+    @property
+    def elapsed(self) -> float:
+        """float: Wall clock seconds between the first encode starting and the last one finishing."""
+        if self.started is None or self.finished is None:
+            return 0.0
+        return self.finished - self.started
+
+    @property
+    def encodes_per_minute(self) -> float:
+        """float: Amount of encodes finished per minute of wall clock time."""
+        return self.encodes / self.elapsed * 60 if self.elapsed > 0 else 0.0
+
+    @property
+    def realtime_factor(self) -> float:
+        """float: Seconds of audio encoded per second of wall clock time."""
+        return self.audio_seconds / self.elapsed if self.elapsed > 0 else 0.0
+
+
+class ConversionScheduler:
+    def __init__(
+        self,
+        max_encodes: int = None,
+        threads_per_encode: int = None,
+        format: Format = Format.MP3,
+        bitrate: str = "320k",
+        targets: list[tuple[Format, str]] = None,
+    ):
+        """Caps the amount of FFmpeg processes running at the same time and the threads each one of them uses, so
+        encodes neither leave cores idle nor oversubscribe the machine. Conversions over the limit wait in a
+        first-in, first-out queue.
+
+        By default, runs one encode per CPU core (from `os.cpu_count()`) and splits the cores evenly between the
+        running encodes.
+
+        Args:
+            max_encodes (int, optional): Maximum amount of encodes running at the same time.
+            threads_per_encode (int, optional): Threads FFmpeg can use for each encode.
+            format (Format): Output format from the Format enum, passed on to `Converter`.
+            bitrate (str): Bitrate passed on to `Converter`.
+            targets (list[tuple[Format, str]], optional): Formats and bitrates that every download is converted to
+                at once, passed on to `Converter`. Replaces `format` and `bitrate` if given.
+        """
+        cores = os.cpu_count() or 1
+        self.max_encodes = max(max_encodes or cores, 1)
+        self.threads_per_encode = threads_per_encode or max(
+            cores // self.max_encodes, 1
+        )
+        self.targets = targets or [(format, bitrate)]
+        self.format, self.bitrate = self.targets[0]
+        _check_targets(self.targets)
+
+        self.stats = EncodeStats()
+        self._running = 0
+        self._waiters: collections.deque[asyncio.Future] = collections.deque()
+
+    @property
+    def pending(self) -> int:
+        """int: Amount of conversions waiting for a free slot."""
+        return len(self._waiters)
+
+    async def convert(
+        self, download: Download, delete_original: bool = True, tags: TagData = None
+    ) -> list[Download]:
+        """Waits for a free slot and converts the download to every target with a `Converter`.
+
+        Args:
+            download (Download): Download object to be converted.
+            delete_original (bool): Whether the source file is deleted after conversion.
+            tags (TagData, optional): Metadata written to the converted files during the conversion.
+
+        Returns:
+            A download object pointing to the converted file of each target, in the same order as the targets.
+        """
+        return await self._run(download, lambda c: c.convert_all(delete_original), tags)
+
+    async def _run(
+        self,
+        download: Download,
+        func: Callable[[Converter], Awaitable[list[Download]]],
+        tags: TagData = None,
+    ) -> list[Download]:
+        await self._acquire()
+        start = time.monotonic()
+        if self.stats.started is None:
+            self.stats.started = start
+
+        try:
+            converter = Converter(
+                download,
+                threads=self.threads_per_encode,
+                targets=self.targets,
+                tags=tags,
+            )
+            converted = await func(converter)
+        except Exception:
+            self.stats.failures += 1
+            raise
+        else:
+            self.stats.encodes += 1
+            self.stats.audio_seconds += download.song.duration
+            return converted
+        finally:
+            end = time.monotonic()
+            self.stats.busy_seconds += end - start
+            self.stats.finished = end
+            self._release()
+            logger.debug(
+                f"Encode finished in {end - start:.2f} seconds ({self._running} running, {self.pending} pending)"
+            )
+
+    async def convert_stream(
+        self,
+        result: AudioSearchResult,
+        stream: AudioStream,
+        output: Path,
+        tags: TagData = None,
+    ) -> list[Download]:
+        """Waits for a free slot and converts audio from a stream to every target with a `Converter`, as it's
+        downloaded.
+
+        FFmpeg runs for as long as the download does, so the slot is held from before the download starts until it
+        ends. In streaming mode, `max_encodes` therefore limits the amount of songs being streamed at the same time,
+        including time FFmpeg spends waiting on the network. The download only starts once there's a slot, so its
+        connection isn't left idle while waiting in the queue.
+
+        Args:
+            result (AudioSearchResult): The search result being streamed.
+            stream (AudioStream): Stream of the source audio, from the audio provider.
+            output (Path): Path of the converted files, without the extension.
+            tags (TagData, optional): Metadata written to the converted files during the conversion.
+
+        Returns:
+            A download object pointing to the converted file of each target, in the same order as the targets.
+        """
+        download = Download.from_parent(
+            result, output, stream.bitrate, stream.audio_codec
+        )
+        return await self._run(download, lambda c: c.convert_stream(stream), tags)
+
+    def report(self):
+        """Logs the encode throughput so far."""
+        logger.info(
+            f"Encoded {self.stats.encodes} songs ({self.stats.failures} failed) in {self.stats.elapsed:.1f} seconds - "
+            f"{self.stats.encodes_per_minute:.1f} encodes/min, {self.stats.realtime_factor:.1f}x realtime, "
+            f"{self.max_encodes} concurrent encodes with {self.threads_per_encode} threads each"
+        )
+
+    async def _acquire(self):
+        if self._running < self.max_encodes and len(self._waiters) == 0:
+            self._running += 1
+            return
+
+        future = asyncio.get_running_loop().create_future()
+        self._waiters.append(future)
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # The slot was handed over right before cancellation, give it to the next in line
+                self._release()
+            elif future in self._waiters:
+                # `_release` may have already skipped over the cancelled future
+                self._waiters.remove(future)
+            raise
 
-        logger.debug("Creating copy of download object")
-        edited_download = copy.copy(self.download)
-        edited_download.filename = Path(output)
-        return edited_download
+    def _release(self):
+        # Hand the slot directly to the oldest waiter, so conversions run in the order they were queued
+        while len(self._waiters) > 0:
+            future = self._waiters.popleft()
+            if not future.done():
+                future.set_result(None)
+                return
+        self._running -= 1
@@ -0,0 +1,126 @@
+"""Cache for cover art images, so songs from the same album don't download the same cover again."""
+
+from __future__ import annotations
+
+import collections
+import hashlib
+import logging
+import os
+import threading
+from concurrent.futures import Future
+from pathlib import Path
+from typing import Optional
+from urllib.request import urlopen
+
+logger = logging.getLogger("downmixer").getChild(__name__)
+
+
+class CoverCache:
+    def __init__(self, max_bytes: int = 64 * 1024 * 1024, folder: Path = None):
+        """Caches cover images by URL in memory, up to `max_bytes`, evicting the least recently used ones first.
+        Optionally, also keeps them on disk in `folder` so they survive between runs.
+
+        If many threads ask for the same cover at the same time, only one of them downloads it and the others wait
+        for that download to finish.
+
+        Args:
+            max_bytes (int): Maximum amount of bytes of images kept in memory.
+            folder (Path, optional): Folder in which images are also saved. Disabled if None.
+        """
+        self.max_bytes = max_bytes
+        self.folder = Path(folder) if folder is not None else None
+
+        self._images: collections.OrderedDict[str, bytes] = collections.OrderedDict()
+        self._size = 0
+        self._in_flight: dict[str, Future] = {}
+        self._lock = threading.Lock()
+
+    def get(self, url: str) -> bytes:
+        """Returns the image from the URL, from the cache if possible.
+
+        Args:
+            url (str): URL of the cover image.
+
+        Returns:
+            The raw image data.
+        """
+        with self._lock:
+            if url in self._images:
+                self._images.move_to_end(url)
+                return self._images[url]
+
+            future = self._in_flight.get(url)
+            is_owner = future is None
+            if is_owner:
+                future = Future()
+                self._in_flight[url] = future
+
+        if not is_owner:
+            logger.debug(f"Waiting for cover image already being fetched from {url}")
+            return future.result()
+
+        try:
+            data = self._read_from_disk(url)
+            if data is None:
+                data = self._fetch(url)
+                self._write_to_disk(url, data)
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            self._store(url, data)
+            future.set_result(data)
+            return data
+        finally:
+            with self._lock:
+                del self._in_flight[url]
+
+    def clear(self):
+        """Removes all images from memory. Images on disk are kept."""
+        with self._lock:
+            self._images.clear()
+            self._size = 0
+
+    @staticmethod
+    def _fetch(url: str) -> bytes:
+        logger.debug(f"Downloading cover image from URL {url}")
+        with urlopen(url) as raw_image:
+            return raw_image.read()
+
+    def _store(self, url: str, data: bytes):
+        if len(data) > self.max_bytes:
+            return
+
+        with self._lock:
+            if url in self._images:
+                return
+            self._images[url] = data
+            self._size += len(data)
+            while self._size > self.max_bytes:
+                _, evicted = self._images.popitem(last=False)
+                self._size -= len(evicted)
+
+    def _disk_path(self, url: str) -> Path:
+        return self.folder.joinpath(hashlib.sha1(url.encode()).hexdigest())
+
+    def _read_from_disk(self, url: str) -> Optional[bytes]:
+        if self.folder is None:
+            return None
+        try:
+            return self._disk_path(url).read_bytes()
+        except OSError:
+            return None
+
+    def _write_to_disk(self, url: str, data: bytes):
+        if self.folder is None:
+            return
+
+        self.folder.mkdir(parents=True, exist_ok=True)
+        path = self._disk_path(url)
+        # Write to a temporary file first, so other processes never read half-written images
+        temp_path = path.with_suffix(f".{threading.get_ident()}.tmp")
+        temp_path.write_bytes(data)
+        os.replace(temp_path, path)
+
+
+default_cache = CoverCache()
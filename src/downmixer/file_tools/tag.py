@@ -1,85 +1,247 @@
 from __future__ import annotations
 
+import base64
 import logging
-from typing import Any, Optional
-from urllib.request import urlopen
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Optional
 
 import mutagen
 
 # noinspection PyProtectedMember
-from mutagen.id3 import APIC, USLT, ID3
-
+from mutagen._tags import PaddingInfo
+from mutagen._vorbis import VComment
+from mutagen.flac import FLAC, Picture
+from mutagen.id3 import (
+    APIC,
+    ID3,
+    TALB,
+    TDOR,
+    TDRC,
+    TIT2,
+    TPE1,
+    TPE2,
+    TRCK,
+    TSOT,
+    TSRC,
+    USLT,
+)
+from mutagen.mp4 import MP4Cover, MP4FreeForm, MP4Tags
+
+from downmixer.file_tools import cover
+from downmixer.file_tools.cover import CoverCache
+from downmixer.library import Song
 from downmixer.providers import Download
 
 logger = logging.getLogger("downmixer").getChild(__name__)
 
 
-def tag_download(download: Download):
-    """Tag the Download with metadata from its `song` attribute, overriding existing metadata.
+@dataclass
+class TagData:
+    """All the metadata written to a file, gathered (including the cover image) before the file is opened.
+
+    Attributes:
+        title (str): Name of the song.
+        artists (list[str]): Names of the song's artists.
+        album (str, optional): Name of the album.
+        album_artists (list[str]): Names of the album's artists.
+        date (str, optional): Release date of the song.
+        isrc (str, optional): ISRC of the song.
+        track_number (int, optional): Position of the song in the album.
+        track_count (int, optional): Amount of songs in the album.
+        lyrics (str, optional): Unsynced lyrics of the song.
+        cover (bytes, optional): JPEG cover image.
+    """
+
+    title: str
+    artists: list[str]
+    album: Optional[str] = None
+    album_artists: Optional[list[str]] = None
+    date: Optional[str] = None
+    isrc: Optional[str] = None
+    track_number: Optional[int] = None
+    track_count: Optional[int] = None
+    lyrics: Optional[str] = None
+    cover: Optional[bytes] = None
+
+    @classmethod
+    def from_song(cls, song: Song, cover_cache: CoverCache = None) -> "TagData":
+        """Gathers the metadata of a song, downloading its cover if it has one.
+
+        Args:
+            song (Song): Song to get the metadata from.
+            cover_cache (CoverCache, optional): Cache used to get the cover image. Defaults to `cover.default_cache`.
+        """
+        album = song.album
+        has_cover = (
+            album is not None and album.cover is not None and len(album.cover) != 0
+        )
+        if has_cover:
+            logger.debug("Getting cover image")
+        return cls(
+            title=song.name,
+            artists=[x.name for x in song.artists],
+            album=album.name if album is not None else None,
+            album_artists=(
+                [x.name for x in album.artists]
+                if album is not None and album.artists
+                else None
+            ),
+            date=song.date or (album.date if album is not None else None),
+            isrc=song.isrc,
+            track_number=song.track_number,
+            track_count=album.track_count if album is not None else None,
+            lyrics=song.lyrics or None,
+            cover=(
+                (cover_cache or cover.default_cache).get(album.cover)
+                if has_cover
+                else None
+            ),
+        )
+
+    @property
+    def track(self) -> Optional[str]:
+        """str: Track number in the "number/total" format used by ID3 and Vorbis comments."""
+        if self.track_number is None:
+            return None
+        if self.track_count is None:
+            return str(self.track_number)
+        return f"{self.track_number}/{self.track_count}"
+
+
+def tag_download(download: Download, cover_cache: CoverCache = None):
+    """Tag the Download with metadata from its `song` attribute, overriding existing metadata. Supports ID3 (MP3 and
+    WAV), Vorbis comments (FLAC and Opus) and MP4 (M4A) tags. All tags are gathered first and the file is only saved
+    once.
 
     Args:
         download (Download): Downloaded file to be tagged with song data.
+        cover_cache (CoverCache, optional): Cache used to get the cover image. Defaults to `cover.default_cache`,
+            which is shared by every call.
     """
     logger.info(f"Tagging file {download.filename}")
-    _save_easy_tag(download)
+    data = TagData.from_song(download.song, cover_cache)
+    write_tags(download.filename, data)
 
-    has_cover = (
-        download.song.album.cover is not None and len(download.song.album.cover) != 0
-    )
-    if download.song.lyrics or has_cover:
-        _save_advanced_tag(download, has_cover)
 
+def write_tags(path: Path, data: TagData):
+    """Replaces the tags of an audio file with the data given, in a single save. The existing padding is kept, so
+    if the new tags fit in the space of the old ones the file is edited in place.
 
-def _save_easy_tag(download: Download):
-    easy_id3 = mutagen.File(download.filename, easy=True)
+    Args:
+        path (Path): Path of the audio file.
+        data (TagData): Metadata to write.
+    """
+    audio = mutagen.File(path)
+    if audio is None:
+        raise ValueError(f"Can't tag '{path}', file type isn't supported")
 
     logger.debug("Deleting old tag information")
-    easy_id3.delete()
-
-    logger.debug(f"Filling with info from attached song '{download.song.title}'")
-    easy_id3["title"] = download.song.name
-    easy_id3["titlesort"] = download.song.name
-    easy_id3["artist"] = download.song.all_artists
-    easy_id3["isrc"] = _return_if_valid(download.song.isrc)
-    easy_id3["album"] = _return_if_valid(download.song.album.name)
-    easy_id3["date"] = _return_if_valid(download.song.date)
-    easy_id3["originaldate"] = _return_if_valid(download.song.date)
-    easy_id3["albumartist"] = _return_if_valid(download.song.album.artists)
-    easy_id3["tracknumber"] = [
-        _return_if_valid(download.song.track_number),
-        _return_if_valid(download.song.album.track_count),
-    ]
-    # TODO: include all tags possible here, grab them from youtube/spotify if needed
-
-    logger.info("Saving EasyID3 data to file")
-    easy_id3.save()
-
-
-def _save_advanced_tag(download: Download, has_cover):
-    id3 = ID3(download.filename)
-    if download.song.lyrics:
-        logger.debug("Adding lyrics")
-        id3["USLT::'eng'"] = USLT(
-            encoding=3, lang="eng", desc="Unsynced Lyrics", text=download.song.lyrics
+    if audio.tags is None:
+        audio.add_tags()
+    else:
+        audio.tags.clear()
+
+    logger.debug(f"Filling with info from song '{data.title}'")
+    if isinstance(audio.tags, ID3):
+        _fill_id3(audio.tags, data)
+    elif isinstance(audio.tags, VComment):
+        _fill_vorbis(audio, data)
+    elif isinstance(audio.tags, MP4Tags):
+        _fill_mp4(audio.tags, data)
+    else:
+        raise ValueError(
+            f"Can't tag '{path}', {type(audio.tags).__name__} tags aren't supported"
+        )
+
+    logger.info("Saving tags to file")
+    audio.save(padding=_keep_padding)
+
+
+def _keep_padding(info: PaddingInfo) -> int:
+    # Keep all the padding left (like the space reserved by `Converter`), so the tags are edited in place. The default
+    # strategy shrinks large padding, which moves the audio data and rewrites the whole file.
+    if info.padding >= 0:
+        return info.padding
+    return info.get_default_padding()
+
+
+def _fill_id3(tags: ID3, data: TagData):
+    tags.add(TIT2(encoding=3, text=data.title))
+    tags.add(TSOT(encoding=3, text=data.title))
+    tags.add(TPE1(encoding=3, text=data.artists))
+    if data.album:
+        tags.add(TALB(encoding=3, text=data.album))
+    if data.album_artists:
+        tags.add(TPE2(encoding=3, text=data.album_artists))
+    if data.date:
+        tags.add(TDRC(encoding=3, text=data.date))
+        tags.add(TDOR(encoding=3, text=data.date))
+    if data.isrc:
+        tags.add(TSRC(encoding=3, text=data.isrc))
+    if data.track:
+        tags.add(TRCK(encoding=3, text=data.track))
+    if data.lyrics:
+        tags.add(USLT(encoding=3, lang="eng", desc="Unsynced Lyrics", text=data.lyrics))
+    if data.cover:
+        tags.add(
+            APIC(encoding=3, mime="image/jpeg", type=3, desc="Cover", data=data.cover)
         )
-    if has_cover:
-        url = download.song.album.cover
-        logger.debug(f"Downloading cover image from URL {url}")
-
-        with urlopen(url) as raw_image:
-            id3["APIC"] = APIC(
-                encoding=3,
-                mime="image/jpeg",
-                type=3,
-                desc="Cover",
-                data=raw_image.read(),
+
+
+def _fill_vorbis(audio: mutagen.FileType, data: TagData):
+    tags = audio.tags
+    tags["title"] = data.title
+    tags["titlesort"] = data.title
+    tags["artist"] = data.artists
+    if data.album:
+        tags["album"] = data.album
+    if data.album_artists:
+        tags["albumartist"] = data.album_artists
+    if data.date:
+        tags["date"] = data.date
+        tags["originaldate"] = data.date
+    if data.isrc:
+        tags["isrc"] = data.isrc
+    if data.track_number is not None:
+        tags["tracknumber"] = str(data.track_number)
+    if data.track_count is not None:
+        tags["tracktotal"] = str(data.track_count)
+    if data.lyrics:
+        tags["lyrics"] = data.lyrics
+
+    # FLAC keeps pictures in their own block, Ogg files keep them inside a comment
+    if isinstance(audio, FLAC):
+        audio.clear_pictures()
+    if data.cover:
+        picture = Picture()
+        picture.type = 3
+        picture.mime = "image/jpeg"
+        picture.desc = "Cover"
+        picture.data = data.cover
+        if isinstance(audio, FLAC):
+            audio.add_picture(picture)
+        else:
+            tags["metadata_block_picture"] = base64.b64encode(picture.write()).decode(
+                "ascii"
             )
-    logger.info("Saving ID3 data to file")
-    id3.save()
 
 
-def _return_if_valid(value: Any | None) -> Optional[Any]:
-    if value is None:
-        return ""
-    else:
-        return value
+def _fill_mp4(tags: MP4Tags, data: TagData):
+    tags["\xa9nam"] = data.title
+    tags["sonm"] = data.title
+    tags["\xa9ART"] = data.artists
+    if data.album:
+        tags["\xa9alb"] = data.album
+    if data.album_artists:
+        tags["aART"] = data.album_artists
+    if data.date:
+        tags["\xa9day"] = data.date
+    if data.isrc:
+        tags["----:com.apple.iTunes:ISRC"] = MP4FreeForm(data.isrc.encode("utf-8"))
+    if data.track_number is not None:
+        tags["trkn"] = [(data.track_number, data.track_count or 0)]
+    if data.lyrics:
+        tags["\xa9lyr"] = data.lyrics
+    if data.cover:
+        tags["covr"] = [MP4Cover(data.cover, imageformat=MP4Cover.FORMAT_JPEG)]
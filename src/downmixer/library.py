@@ -1,11 +1,112 @@
-"""Data classes to hold standardized metadata about songs, artists, and albums."""
+"""Data classes to hold standardized metadata about songs, artists, and albums.
 
+Library items use `__slots__` to keep large libraries small in memory. Info providers can also share artists and albums
+between songs with an `Interner`, and share lists of markets with `intern_markets`.
+"""
+
+import dataclasses
+import functools
+import threading
+import weakref
 from dataclasses import dataclass
 from enum import Enum
-from typing import Optional, Any
+from typing import Optional, Any, Callable, Iterable, TypeVar
 
 from slugify import slugify
 
+T = TypeVar("T")
+
+
+@functools.lru_cache(maxsize=16384)
+def slug_text(text: str) -> str:
+    """Slugifies the text. Results are kept in a least recently used cache keyed by the text, since the same names
+    (like an artist with many songs, or a song compared with many search results) are slugified many times.
+
+    Args:
+        text (str): Text to slugify.
+
+    Returns:
+        The slugified text.
+    """
+    return slugify(text)
+
+
+def _slotted(weakref_slot: bool = False) -> Callable[[type], type]:
+    """Makes a dataclass use `__slots__`, like `dataclass(slots=True)` does since Python 3.10. Must be applied after
+    (above) `@dataclass`.
+
+    Args:
+        weakref_slot (bool): Also add a `__weakref__` slot, so instances can be kept in an `Interner`.
+    """
+
+    def wrap(cls: type) -> type:
+        namespace = dict(cls.__dict__)
+        field_names = tuple(x.name for x in dataclasses.fields(cls))
+        # Defaults are already part of the generated __init__, and would clash with the slots of the same name
+        for name in field_names:
+            namespace.pop(name, None)
+        namespace.pop("__dict__", None)
+        namespace.pop("__weakref__", None)
+        namespace["__slots__"] = field_names + (
+            ("__weakref__",) if weakref_slot else ()
+        )
+        return type(cls)(cls.__name__, cls.__bases__, namespace)
+
+    return wrap
+
+
+_markets: dict[frozenset, frozenset] = {}
+_markets_lock = threading.Lock()
+
+
+def intern_markets(markets: Optional[Iterable[str]]) -> Optional[frozenset]:
+    """Returns the markets as a frozen set that is shared by every item with the same markets, since most songs and
+    albums are available in the exact same list of countries.
+
+    Args:
+        markets (Iterable[str], optional): Country codes of the markets.
+
+    Returns:
+        The shared frozen set of markets, or None if `markets` is None.
+    """
+    if markets is None:
+        return None
+
+    key = frozenset(markets)
+    with _markets_lock:
+        return _markets.setdefault(key, key)
+
+
+class Interner:
+    def __init__(self):
+        """Keeps a single instance of each library item by its ID, so songs with the same artists or album share the
+        same objects instead of each holding a copy. Items are only kept while something else references them.
+
+        Since interned items are shared, they shouldn't be modified after being created.
+        """
+        self._items: weakref.WeakValueDictionary = weakref.WeakValueDictionary()
+        self._lock = threading.Lock()
+
+    def get(self, key: Optional[str], factory: Callable[[], T]) -> T:
+        """Returns the item with the key given, making it with `factory` if there's none yet.
+
+        Args:
+            key (str, optional): Unique ID of the item. Items without an ID are always made and never shared.
+            factory (Callable): Function that makes the item.
+        """
+        if key is None:
+            return factory()
+
+        with self._lock:
+            item = self._items.get(key)
+        if item is not None:
+            return item
+
+        item = factory()
+        with self._lock:
+            # Another thread may have made the same item in the meantime, keep the first one
+            return self._items.setdefault(key, item)
+
 
 class AlbumType(Enum):
     ALBUM = 1
@@ -19,6 +120,8 @@ class BaseLibraryItem:
     [implemented in all info providers.](../providers/library.py file.md)
     """
 
+    __slots__ = ()
+
     @classmethod
     def from_provider(cls, data: Any, extra_data: dict = None):
         """Create an instance of this class from data coming from a provider's API.
@@ -46,6 +149,7 @@ class BaseLibraryItem:
         return [cls.from_provider(x) for x in data]
 
 
+@_slotted(weakref_slot=True)
 @dataclass
 class Artist(BaseLibraryItem):
     """Holds info about an artist."""
@@ -59,20 +163,21 @@ class Artist(BaseLibraryItem):
     def slug(self) -> "Artist":
         """Returns self with sluggified text attributes."""
         return Artist(
-            name=slugify(self.name),
+            name=slug_text(self.name),
             images=self.images,
-            genres=[slugify(x) for x in self.genres] if self.genres else None,
+            genres=[slug_text(x) for x in self.genres] if self.genres else None,
             id=self.id,
             url=self.url,
         )
 
 
+@_slotted(weakref_slot=True)
 @dataclass
 class Album(BaseLibraryItem):
     """Holds info about an album. `cover` should be a string containing a valid URL."""
 
     name: str
-    available_markets: Optional[list[str]] = None
+    available_markets: Optional[frozenset[str]] = None
     artists: Optional[list[Artist]] = None
     date: Optional[str] = None
     track_count: Optional[int] = None
@@ -83,9 +188,9 @@ class Album(BaseLibraryItem):
     def slug(self) -> "Album":
         """Returns self with sluggified text attributes."""
         return Album(
-            name=slugify(self.name),
+            name=slug_text(self.name),
             available_markets=self.available_markets,
-            artists=[x.slug for x in self.artists] if self.artists else None,
+            artists=[x.slug() for x in self.artists] if self.artists else None,
             date=self.date,
             track_count=self.track_count,
             cover=self.cover,
@@ -94,6 +199,7 @@ class Album(BaseLibraryItem):
         )
 
 
+@_slotted()
 @dataclass
 class Song(BaseLibraryItem):
     """Holds info about a song."""
@@ -102,7 +208,7 @@ class Song(BaseLibraryItem):
     artists: list[Artist]
     duration: float = 0  # in seconds
     album: Optional[Album] = None
-    available_markets: Optional[list[str]] = None
+    available_markets: Optional[frozenset[str]] = None
     date: Optional[str] = None
     track_number: Optional[int] = None
     isrc: Optional[str] = None
@@ -112,9 +218,9 @@ class Song(BaseLibraryItem):
     cover: Optional[str] = None
 
     def slug(self) -> "Song":
-        """Returns self with sluggified text attributes."""
+        """Returns self with sluggified text attributes. Lyrics are kept as they are."""
         return Song(
-            name=slugify(self.name),
+            name=slug_text(self.name),
             artists=[x.slug() for x in self.artists],
             album=self.album.slug() if self.album else None,
             available_markets=self.available_markets,
@@ -124,7 +230,7 @@ class Song(BaseLibraryItem):
             isrc=self.isrc,
             id=self.id,
             url=self.url,
-            lyrics=slugify(self.lyrics) if self.lyrics else None,
+            lyrics=self.lyrics,
         )
 
     @property
@@ -143,6 +249,7 @@ class Song(BaseLibraryItem):
         return ", ".join(x.name for x in self.artists)
 
 
+@_slotted()
 @dataclass
 class Playlist(BaseLibraryItem):
     name: str
@@ -3,18 +3,26 @@ comparison with the [RapidFuzz package](https://github.com/maxbachmann/RapidFuzz
 
 Matching is done individually on song name, primary artist, other artists, album name, and length - artist matches are
 calculated down to a single score value (scores go from 0 to 100). Therefore, the sum can be a range of 0 to 400.
+
+To compare a song with many results at once, like the results of a search, use `match_many`, which scores all of them
+with a few matrix calls instead of one call per pair of strings.
 """
 
 from __future__ import annotations
 
 from dataclasses import dataclass
 from enum import Enum
-from typing import Tuple, Optional
+from typing import Tuple, Optional, NamedTuple
 
-from rapidfuzz import fuzz
+import numpy as np
+from rapidfuzz import fuzz, process
 
 import downmixer.matching.utils
-from downmixer.library import Artist, Song
+from downmixer.library import Artist, Song, slug_text
+
+
+# Length difference, in seconds, at which the length score reaches zero
+LENGTH_CEILING = 120
 
 
 class MatchQuality(Enum):
@@ -102,23 +110,46 @@ class MatchResult:
         return name_test and artists_test and album_test and length_test
 
 
+class _SongSlug(NamedTuple):
+    """Slugified text of the fields of a song used when matching."""
+
+    name: str
+    artists: list[str]
+    album: Optional[str]
+
+
+def _slug(song: Song) -> _SongSlug:
+    """Slugifies only the fields used when matching, through the cache of `slug_text`, without copying the song."""
+    return _SongSlug(
+        name=slug_text(song.name),
+        artists=[slug_text(x.name) for x in song.artists],
+        album=slug_text(song.album.name) if song.album is not None else None,
+    )
+
+
 def match(original_song: Song, result_song: Song) -> MatchResult:
-    """Returns match values using RapidFuzz comparing the two given song objects.
+    """Returns match values using RapidFuzz comparing the two given song objects. Text is slugified before being
+    compared. Songs with the same ISRC are a perfect match without being compared.
 
     Args:
-        original_song (Song): Song to be compared to. Should be slugified for better results.
-        result_song (Song): Song being compared. Should be slugified for better results.
+        original_song (Song): Song to be compared to.
+        result_song (Song): Song being compared.
 
     Returns:
         MatchResult: Match scores of the comparison between original and result song.
     """
-    song_slug = original_song.slug()
-    result_slug = result_song.slug()
+    if _same_isrc(original_song, result_song):
+        return _isrc_match(original_song)
+
+    song_slug = _slug(original_song)
+    result_slug = _slug(result_song)
 
     name_match = _match_simple(song_slug.name, result_slug.name)
-    artists_matches = _match_artist_list(song_slug, result_slug)
+    artists_matches = _match_artist_list(
+        original_song.artists, song_slug.artists, result_slug.artists
+    )
     if result_slug.album is not None:
-        album_match = _match_simple(song_slug.album.name, result_slug.album.name)
+        album_match = _match_simple(song_slug.album or "", result_slug.album)
     else:
         album_match = 0.0
     length_match = _match_length(original_song.duration, result_song.duration)
@@ -132,6 +163,204 @@ def match(original_song: Song, result_song: Song) -> MatchResult:
     )
 
 
+def match_many(
+    original_song: Song,
+    result_songs: list[Song],
+    min_quality: MatchQuality = None,
+    length_ceiling: int = LENGTH_CEILING,
+) -> list[Tuple[Song, MatchResult]]:
+    """Compares a song with many results at once, scoring every result's name, album and artists with one
+    [`process.cdist`](https://rapidfuzz.github.io/RapidFuzz/Usage/process.html#cdist) call each and every length
+    with NumPy. Gives the same scores as calling `match` for each result.
+
+    Results are dropped before any fuzzy matching when their length differs from the song's by more than
+    `length_ceiling` seconds (if both lengths are known), and results with the same ISRC as the song are perfect
+    matches right away. If `min_quality` is given, results that can't reach it are dropped as soon as that's known,
+    skipping the rest of their scores.
+
+    Args:
+        original_song (Song): Song to be compared to.
+        result_songs (list[Song]): Songs being compared, usually results of a search.
+        min_quality (MatchQuality, optional): Lowest quality a result must have to be returned.
+        length_ceiling (int): Length difference, in seconds, at which the length score reaches zero.
+
+    Returns:
+        Each result song that wasn't dropped and its `MatchResult`, ordered from highest to lowest match sum.
+        Results with the same sum keep the order they were given in.
+    """
+    matches: list[Optional[MatchResult]] = [None] * len(result_songs)
+    for i, result_song in enumerate(result_songs):
+        if _same_isrc(original_song, result_song):
+            matches[i] = _isrc_match(original_song)
+
+    # Scores of the results still being matched, one value per result in `viable`
+    viable = np.array(
+        [
+            i
+            for i, x in enumerate(result_songs)
+            if matches[i] is None
+            and not _too_long(original_song.duration, x.duration, length_ceiling)
+        ],
+        dtype=int,
+    )
+    length_matches = np.array(
+        _match_lengths(
+            original_song.duration,
+            [result_songs[i].duration for i in viable],
+            length_ceiling,
+        ),
+        dtype=np.float64,
+    )
+    # Score each result still needs from the fields not scored yet, to reach the minimum quality
+    needed = (
+        min_quality.value - length_matches
+        if min_quality is not None
+        else np.full(len(viable), -np.inf)
+    )
+
+    song_slug = _slug(original_song)
+    result_slugs = [_slug(result_songs[i]) for i in viable]
+
+    # Name and album can score at most 100 each and the artists 100 on average, so results that can't make up the
+    # difference with the fields left are dropped before those are scored
+    name_matches = _match_column(
+        song_slug.name, [x.name for x in result_slugs], _cutoff(needed - 200)
+    )
+    keep = name_matches >= needed - 200
+    viable, needed, length_matches, name_matches = (
+        viable[keep],
+        needed[keep] - name_matches[keep],
+        length_matches[keep],
+        name_matches[keep],
+    )
+    result_slugs = [x for x, k in zip(result_slugs, keep) if k]
+
+    album_matches = _match_column(
+        song_slug.album or "", [x.album for x in result_slugs], _cutoff(needed - 100)
+    )
+    keep = album_matches >= needed - 100
+    viable, needed, length_matches, name_matches, album_matches = (
+        viable[keep],
+        needed[keep] - album_matches[keep],
+        length_matches[keep],
+        name_matches[keep],
+        album_matches[keep],
+    )
+    result_slugs = [x for x, k in zip(result_slugs, keep) if k]
+
+    artists_matches = _match_artist_lists(
+        original_song.artists, song_slug, result_slugs
+    )
+    for i, name_match, album_match, artists_match, length_match in zip(
+        viable.tolist(),
+        name_matches.tolist(),
+        album_matches.tolist(),
+        artists_matches,
+        length_matches.astype(int).tolist(),
+    ):
+        matches[i] = MatchResult(
+            method="WRatio",
+            name_match=name_match,
+            artists_match=artists_match,
+            album_match=album_match,
+            length_match=length_match,
+        )
+
+    ranked = sorted(
+        (i for i, x in enumerate(matches) if x is not None),
+        key=lambda i: matches[i].sum,
+        reverse=True,
+    )
+    return [
+        (result_songs[i], matches[i])
+        for i in ranked
+        if min_quality is None or matches[i].sum >= min_quality.value
+    ]
+
+
+def _same_isrc(original_song: Song, result_song: Song) -> bool:
+    return original_song.isrc is not None and original_song.isrc == result_song.isrc
+
+
+def _isrc_match(original_song: Song) -> MatchResult:
+    """Makes a perfect match for a result with the same ISRC as the song, which is the same recording."""
+    return MatchResult(
+        method="ISRC",
+        name_match=100.0,
+        artists_match=[(x, 100.0) for x in original_song.artists],
+        album_match=100.0,
+        length_match=100,
+    )
+
+
+def _too_long(len1: float, len2: float, ceiling: int) -> bool:
+    """Checks if two lengths are too far apart to match. Lengths of zero are unknown, and never too far apart."""
+    return len1 > 0 and len2 > 0 and abs(len1 - len2) > ceiling
+
+
+def _cutoff(needed: np.ndarray) -> float:
+    """Returns the score cutoff for a column of results, so RapidFuzz can skip scoring a result in detail once it's
+    clear it's below the lowest score needed by any of them."""
+    if len(needed) == 0:
+        return 0
+    return float(np.clip(needed.min(), 0, 100))
+
+
+def _match_column(
+    string: str, choices: list[str | None], score_cutoff: float = 0
+) -> np.ndarray:
+    """Calculates the match score of a string with each of the choices at once. Choices that are None score zero,
+    like in `_match_simple`. Scores below `score_cutoff` are zero."""
+    if len(choices) == 0:
+        return np.zeros(0)
+    scores = process.cdist(
+        [string],
+        [x if x is not None else "" for x in choices],
+        scorer=fuzz.WRatio,
+        dtype=np.float64,
+        score_cutoff=score_cutoff,
+    )
+    return scores[0]
+
+
+def _match_artist_lists(
+    artists: list[Artist], slug_song: _SongSlug, slug_results: list[_SongSlug]
+) -> list[list[Tuple[Artist, float]]]:
+    """Calculates the same scores as `_match_artist_list` for each result, comparing the song's artists with the
+    artists of every result in a single matrix."""
+    result_names = [name for x in slug_results for name in x.artists]
+    if len(slug_song.artists) == 0 or len(result_names) == 0:
+        return [[] for _ in slug_results]
+
+    # One row per artist of the song, one column per artist of every result, in order
+    scores = process.cdist(
+        slug_song.artists,
+        result_names,
+        scorer=fuzz.WRatio,
+        dtype=np.float64,
+    )
+
+    counts = np.array([len(x.artists) for x in slug_results])
+    starts = np.cumsum(counts) - counts
+    has_artists = counts > 0
+    # Results without artists have no columns, so each segment only holds the columns of its own result
+    best = np.maximum.reduceat(scores, starts[has_artists], axis=1)
+
+    artist_matches = [[] for _ in slug_results]
+    for column, index in enumerate(np.flatnonzero(has_artists)):
+        artist_matches[index] = list(zip(artists, best[:, column].tolist()))
+    return artist_matches
+
+
+def _match_lengths(
+    len1: float, lengths: list[float], ceiling: int = LENGTH_CEILING
+) -> list[float]:
+    """Calculates the same score as `_match_length` for each length at once."""
+    x = np.abs(len1 - np.asarray(lengths, dtype=np.float64)) / ceiling
+    y = np.where(x < 0.5, 1 - 4 * x**3, ((-2 * x + 2) ** 3) / 2) * 100
+    return np.clip(np.trunc(y), 0, 100).astype(int).tolist()
+
+
 def _match_simple(str1: str, str2: str | None) -> float:
     """Calculates match score for two strings. The second string can be None and will be treated as empty if such."""
     try:
@@ -143,14 +372,15 @@ def _match_simple(str1: str, str2: str | None) -> float:
 
 
 def _match_artist_list(
-    slug_song: Song, slug_result: Song
+    artists: list[Artist], slug_artists: list[str], slug_result_artists: list[str]
 ) -> list[Tuple[Artist, float]]:
-    """Uses _match_simple to calculate match score of all the artists from a song."""
+    """Uses _match_simple to calculate match score of all the artists from a song, given along with their slugified
+    names."""
     artist_matches = []
-    for artist in slug_song.artists:
+    for artist, slug_artist in zip(artists, slug_artists):
         highest_ratio: Tuple[Optional[Artist], float] = (None, -1.0)
-        for result_artist in slug_result.artists:
-            ratio = _match_simple(artist.name, result_artist.name)
+        for slug_result_artist in slug_result_artists:
+            ratio = _match_simple(slug_artist, slug_result_artist)
             if ratio > highest_ratio[1]:
                 highest_ratio = (artist, ratio)
 
@@ -160,7 +390,7 @@ def _match_artist_list(
     return artist_matches
 
 
-def _match_length(len1: float, len2: float, ceiling: int = 120):
+def _match_length(len1: float, len2: float, ceiling: int = LENGTH_CEILING):
     """Plots the difference between `len1` and `len2` in a [graph](https://www.desmos.com/calculator/3guvoyxg4z) and
     returns the y value of this graph. The `ceiling` parameter defines the scale of the x-axis.
     """
@@ -3,26 +3,104 @@
 from __future__ import annotations
 
 import asyncio
+import contextlib
 import logging
+import os
 import shutil
+import tempfile
+import time
+from dataclasses import asdict, dataclass, field
+from enum import Enum
 from pathlib import Path
-from typing import Type
+from typing import (
+    Type,
+    Optional,
+    AsyncIterator,
+    Iterable,
+    Awaitable,
+    Any,
+    Callable,
+)
 
-from downmixer.file_tools import tag, utils
-from downmixer.file_tools.convert import Converter
+from downmixer.file_tools import tag, utils, Format
+from downmixer.file_tools.convert import ConversionScheduler
+from downmixer.library import Song
+from downmixer.processing import retry
+from downmixer.processing.manifest import SyncManifest
+from downmixer.processing.retry import RetryPolicy
 from downmixer.providers import (
+    AudioSearchResult,
     Download,
     BaseInfoProvider,
     BaseAudioProvider,
     BaseLyricsProvider,
 )
+from downmixer.providers.matches import MatchStore
+from downmixer.providers.pool import ProviderPool
 
 logger = logging.getLogger("downmixer").getChild(__name__)
 
 
-async def _convert_download(download: Download) -> Download:
-    converter = Converter(download)
-    return await converter.convert()
+def _retrieve_exception(future: asyncio.Future):
+    if not future.cancelled():
+        future.exception()
+
+
+class TrackStatus(Enum):
+    DONE = 1
+    SKIPPED = 2
+    NOT_FOUND = 3
+    FAILED = 4
+
+
+@dataclass
+class TrackResult:
+    """Outcome of processing a single song.
+
+    Attributes:
+        song (str | Song): The song as it was given to the processor, or the `Song` object once it was resolved.
+        status (TrackStatus): How processing the song ended.
+        download (Download, optional): The final download, if the song was processed successfully.
+        path (Path, optional): Final path of the file in the output folder.
+        error (Exception, optional): The exception that made processing fail.
+        reason (str, optional): Human-readable reason for the song being skipped or failing.
+        timings (dict[str, float]): Seconds spent on each step of processing, keyed by the step name.
+        outputs (list[Download]): The final download of each output format. `download` and `path` are the first one.
+    """
+
+    song: str | Song
+    status: TrackStatus = TrackStatus.DONE
+    download: Optional[Download] = None
+    path: Optional[Path] = None
+    error: Optional[Exception] = None
+    reason: Optional[str] = None
+    timings: dict[str, float] = field(default_factory=dict)
+    outputs: list[Download] = field(default_factory=list)
+
+    @property
+    def song_id(self) -> str:
+        """str: ID of the song."""
+        return self.song.id if isinstance(self.song, Song) else self.song
+
+    @property
+    def total_time(self) -> float:
+        """float: Sum of the time spent on all steps."""
+        return sum(self.timings.values())
+
+    @contextlib.contextmanager
+    def time(self, step: str):
+        """Context manager that records the time spent inside it under the step name given."""
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.timings[step] = self.timings.get(step, 0.0) + time.monotonic() - start
+
+    def fail(self, error: Exception):
+        """Marks the song as failed because of the exception given."""
+        self.status = TrackStatus.FAILED
+        self.error = error
+        self.reason = f"{retry.classify(error).name.lower()} error: {error}"
 
 
 class BasicProcessor:
@@ -36,6 +114,14 @@ class BasicProcessor:
         temp_folder: Path,
         threads: int = 3,
         max_retries: int = 10,
+        max_encodes: int = None,
+        use_manifest: bool = False,
+        retry_policy: RetryPolicy = None,
+        match_store: MatchStore = None,
+        stream_downloads: bool = False,
+        output_format: Format = Format.MP3,
+        output_targets: list[tuple[Format, str]] = None,
+        embed_tags: bool = False,
     ):
         """Basic processing class to search an ID and download it, using the providers passed on by the user. For
         playlist downloads, it uses an [`asyncio.Semaphore`](
@@ -51,6 +137,28 @@ class BasicProcessor:
             temp_folder (str): Folder path where temporary files will be placed and removed from when processing
                 is finished.
             threads (int): Amount of threads that will simultaneously process songs.
+            max_retries (int): Amount of times each step of processing a song is retried before giving up on it.
+                Ignored if `retry_policy` is given.
+            max_encodes (int, optional): Maximum amount of FFmpeg conversions running at the same time. Defaults to
+                the number of CPU cores. With `stream_downloads`, also the maximum amount of songs being downloaded
+                at the same time, since each conversion lasts as long as its download.
+            use_manifest (bool): Keep a `SyncManifest` in the output folder and skip songs that were already synced
+                and whose files are still valid.
+            retry_policy (RetryPolicy, optional): Policy used to retry failed steps. Defaults to a `RetryPolicy` with
+                `max_retries`.
+            match_store (MatchStore, optional): Store of previous matches. Songs found in it skip the search step, and
+                new matches are saved to it.
+            stream_downloads (bool): If the audio provider supports it, feed the audio straight into FFmpeg as it's
+                downloaded and write the converted file next to its final location, instead of saving the download
+                to `temp_folder` first.
+            output_format (Format): Format of the final files. Audio providers are asked for audio that fits it, and
+                audio already in a codec the format can hold is copied instead of encoded again.
+            output_targets (list[tuple[Format, str]], optional): Formats and bitrates to convert every song to, all
+                in the same FFmpeg run. Each one is tagged and placed in the output folder. Replaces `output_format`
+                if given, with the first target being used for the manifest and for audio provider negotiation.
+            embed_tags (bool): Have FFmpeg write the song's metadata and cover image while converting, with room
+                left for later edits. Tagging then only edits the tags in place, instead of writing the whole file
+                again. Lyrics found before the conversion starts are embedded too.
         """
         self.output_folder: Path = Path(output_folder).absolute()
         self.temp_folder = temp_folder
@@ -60,69 +168,456 @@ class BasicProcessor:
         self.audio_provider_settings = audio_provider_settings
         self.lyrics_provider = lyrics_provider
 
-        self.max_retries = max_retries
+        self.retry_policy = retry_policy or RetryPolicy(max_retries)
+        self.threads = threads
         self.semaphore = asyncio.Semaphore(threads)
+        self.audio_provider_pool = ProviderPool(
+            audio_provider_class, audio_provider_settings, threads
+        )
+        self.conversion_scheduler = ConversionScheduler(
+            max_encodes, format=output_format, targets=output_targets
+        )
+        self.match_store = match_store
+        self.stream_downloads = stream_downloads
+        self.embed_tags = embed_tags
+        self.manifest = (
+            SyncManifest.in_folder(self.output_folder) if use_manifest else None
+        )
+        self._active_runs = 0
+
+    @contextlib.asynccontextmanager
+    async def _run(self) -> AsyncIterator[None]:
+        """Wraps every call that processes songs. Once the last one running finishes, the lyrics provider's
+        connections are closed, so they aren't left open after the processor is done (or its event loop closed).
+        Providers open them again the next time they're needed."""
+        self._active_runs += 1
+        try:
+            yield
+        finally:
+            self._active_runs -= 1
+            if self._active_runs == 0:
+                await self.lyrics_provider.close()
+
+    def _is_synced(self, song_id: str) -> bool:
+        """Checks the manifest (if enabled) to see if a song can be skipped."""
+        if self.manifest is None or song_id is None:
+            return False
 
-    async def _get_lyrics(self, download: Download):
+        synced = self.manifest.is_synced(
+            song_id, self.conversion_scheduler.format.value
+        )
+        if synced:
+            logger.info(f"Song '{song_id}' was already synced, skipping")
+        return synced
+
+    async def _fetch_lyrics(self, song: Song) -> Optional[str]:
+        """Searches the lyrics of the song with the lyrics provider. Only needs the song's metadata, so it can run
+        alongside the download and conversion of the song. Lyrics are optional, so errors are logged and None is
+        returned instead of failing the song."""
         # TODO: Test if lyrics are actually working
-        lyrics_results = await self.lyrics_provider.search(download.song)
-        if lyrics_results is not None:
-            lyrics = await self.lyrics_provider.get_lyrics(lyrics_results[0])
-            download.song.lyrics = lyrics
+        host = retry.host_name(self.lyrics_provider)
+        try:
+            lyrics_results = await self.retry_policy.call(
+                host, self.lyrics_provider.search, song
+            )
+            if not lyrics_results:
+                logger.info(f"No lyrics found for '{song.title}'")
+                return None
+            return await self.retry_policy.call(
+                host, self.lyrics_provider.get_lyrics, lyrics_results[0]
+            )
+        except Exception as e:
+            logger.warning(f"Failed getting lyrics for '{song.title}'", exc_info=e)
+            return None
 
-    async def pool_processing(self, song_id: str):
-        async with self.semaphore:
-            logger.debug(f"Processing song '{song_id}'")
-            retries = 0
-            while retries <= self.max_retries:
-                try:
-                    await self.process_song(song_id)
-                    return
-                except Exception as e:
-                    # TODO: Pick out exceptions instead of catching all exceptions
-                    logger.warning(
-                        f"Error processing song '{song_id}', retrying ({self.max_retries - retries} left)",
-                        exc_info=e,
-                    )
-                    retries += 1
+    @staticmethod
+    async def _timed(
+        track: TrackResult, step: str, func: Callable[..., Awaitable], *args
+    ) -> Any:
+        with track.time(step):
+            return await func(*args)
 
-            logger.error(f"Max retries exceeded for song '{song_id}'")
+    async def pool_processing(self, song: str | Song) -> TrackResult:
+        result = TrackResult(song)
+        async with self.semaphore:
+            logger.debug(f"Processing song '{result.song_id}'")
+            try:
+                await self._process_song(result)
+            except Exception as e:
+                # Each step was already retried according to the retry policy
+                result.fail(e)
+                logger.error(
+                    f"Failed processing song '{result.song_id}' ({result.reason})",
+                    exc_info=e,
+                )
+        return result
 
     async def process_playlist(self, playlist_id: str):
         """Searches and downloads all songs in a playlist using a queue with limited threads.
 
         Args:
             playlist_id (str): ID for the playlist to be downloaded."""
-        songs = self.info_provider.get_all_playlist_songs(playlist_id)
+        async for _ in self.iter_playlist(playlist_id):
+            pass
+        self.conversion_scheduler.report()
+
+    async def iter_playlist(self, playlist_id: str) -> AsyncIterator[TrackResult]:
+        """Processes all songs in a playlist, yielding a `TrackResult` for each one as soon as it finishes. Use it
+        with `async for`:
+
+        ```python
+        async for result in processor.iter_playlist(playlist_id):
+            print(result.song_id, result.status, result.timings)
+        ```
+
+        Args:
+            playlist_id (str): ID for the playlist to be downloaded.
+
+        Yields:
+            TrackResult of each song, in the order they finish.
+        """
+        songs = await self.retry_policy.call(
+            retry.host_name(self.info_provider),
+            self.info_provider.get_all_playlist_songs,
+            playlist_id,
+        )
+        async for result in self.iter_songs(songs):
+            yield result
+
+    async def sync_playlist(
+        self, playlist_id: str, prune: bool = False
+    ) -> list[TrackResult]:
+        """Brings the output folder up to date with the playlist, using the state saved in the manifest by the
+        previous sync. If the info provider says the playlist didn't change since then and no synced file was
+        deleted, nothing else is requested. Otherwise, only songs added since the last sync, and songs whose files
+        were deleted, are processed.
+
+        Opens the manifest if the processor was created without it, since it's where the playlist state is kept.
+
+        Args:
+            playlist_id (str): ID for the playlist to be synced.
+            prune (bool): If True, deletes the files of songs removed from the playlist, unless another synced
+                playlist still has them.
+
+        Returns:
+            TrackResult of each song processed.
+        """
+        if self.manifest is None:
+            self.manifest = SyncManifest.in_folder(self.output_folder)
+
+        info_host = retry.host_name(self.info_provider)
+        snapshot_id = await self.retry_policy.call(
+            info_host, self.info_provider.get_playlist_snapshot, playlist_id
+        )
+        state = self.manifest.get_playlist(playlist_id)
+        # Songs whose files were deleted are processed again, even if the playlist didn't change
+        deleted = self._deleted_songs(state.song_ids) if state is not None else set()
+        if (
+            state is not None
+            and snapshot_id is not None
+            and state.snapshot_id == snapshot_id
+            and len(deleted) == 0
+        ):
+            logger.info(f"Playlist '{playlist_id}' didn't change, skipping")
+            return []
+
+        songs = await self.retry_policy.call(
+            info_host,
+            self.info_provider.get_all_playlist_songs,
+            playlist_id,
+            snapshot_id,
+        )
+        song_ids = [x.id for x in songs]
+        known_ids = (
+            set(state.song_ids).difference(deleted) if state is not None else set()
+        )
+        added = [x for x in songs if x.id not in known_ids]
+        removed = known_ids.difference(song_ids)
+        logger.info(
+            f"Playlist '{playlist_id}' changed: {len(added)} songs added, {len(removed)} removed"
+        )
+
+        results = [x async for x in self.iter_songs(added)]
+        failed = {x.song_id for x in results if x.status == TrackStatus.FAILED}
+        if prune:
+            for song_id in removed:
+                self._prune(song_id, playlist_id)
+
+        # Failed songs aren't recorded, and neither is the snapshot, so the next sync tries them again
+        self.manifest.record_playlist(
+            playlist_id,
+            snapshot_id if len(failed) == 0 else None,
+            [x for x in song_ids if x not in failed],
+        )
+        return results
+
+    def _deleted_songs(self, song_ids: list[str]) -> set[str]:
+        """Returns the songs, of the ones given, that were synced to a file that doesn't exist anymore."""
+        deleted = set()
+        for song_id in song_ids:
+            entry = self.manifest.get(song_id)
+            if entry is not None and not entry.path.exists():
+                deleted.add(song_id)
+        return deleted
+
+    def _prune(self, song_id: str, playlist_id: str):
+        """Deletes the file of a song removed from a playlist, if no other synced playlist has it."""
+        if self.manifest.is_in_other_playlist(song_id, playlist_id):
+            return
 
-        tasks = [self.pool_processing(s.id) for s in songs]
-        await asyncio.gather(*tasks)
+        entry = self.manifest.get(song_id)
+        if entry is not None and entry.is_valid():
+            logger.info(f"Removing '{entry.path}', no longer in playlist")
+            entry.path.unlink()
+        self.manifest.remove(song_id)
 
-    async def process_song(self, song_id: str):
+    async def watch(
+        self, playlist_ids: list[str], interval: float = 300.0, prune: bool = False
+    ):
+        """Syncs the playlists given every `interval` seconds, forever. Since `sync_playlist` is used, polling an
+        unchanged playlist only costs a single lightweight request to the info provider.
+
+        Args:
+            playlist_ids (list[str]): IDs of the playlists to watch.
+            interval (float): Seconds to wait between the end of one round of syncs and the start of the next.
+            prune (bool): If True, deletes the files of songs removed from the playlists.
+        """
+        while True:
+            for playlist_id in playlist_ids:
+                try:
+                    await self.sync_playlist(playlist_id, prune)
+                except Exception as e:
+                    logger.error(f"Failed syncing playlist '{playlist_id}'", exc_info=e)
+            logger.debug(f"Waiting {interval} seconds before syncing again")
+            await asyncio.sleep(interval)
+
+    async def iter_songs(
+        self, songs: Iterable[str | Song]
+    ) -> AsyncIterator[TrackResult]:
+        """Processes the songs given, yielding a `TrackResult` for each one as soon as it finishes. Only `threads`
+        songs are processed at a time, and new songs only start once the consumer asks for the next result, so memory
+        use stays bounded no matter how many songs there are. Stopping the iteration cancels the songs in progress.
+
+        Args:
+            songs (Iterable[str | Song]): IDs or `Song` objects to be processed. Can be a lazy iterable.
+
+        Yields:
+            TrackResult of each song, in the order they finish.
+        """
+        songs = iter(songs)
+        pending: set[asyncio.Task] = set()
+
+        def admit():
+            while len(pending) < self.threads:
+                song = next(songs, None)
+                if song is None:
+                    return
+                pending.add(asyncio.create_task(self.pool_processing(song)))
+
+        async with self._run():
+            admit()
+            try:
+                while len(pending) > 0:
+                    done, _ = await asyncio.wait(
+                        pending, return_when=asyncio.FIRST_COMPLETED
+                    )
+                    for task in done:
+                        pending.remove(task)
+                        yield task.result()
+                    admit()
+            finally:
+                for task in pending:
+                    task.cancel()
+
+    async def _resolve_song(self, song: str | Song) -> Song:
+        """Returns the song as is if it's already a `Song` object, otherwise retrieves it from the info provider."""
+        if isinstance(song, Song):
+            return song
+        return await self.retry_policy.call(
+            retry.host_name(self.info_provider), self.info_provider.get_song, song
+        )
+
+    async def process_song(self, song: str | Song) -> TrackResult:
         """Searches and downloads a single song based on data provided by a `BaseInfoProvider`.
 
         Args:
-            song_id (str): Valid ID of a single track.
+            song (str | Song): Valid ID of a single track, or a `Song` already retrieved from the info provider (for
+                example, from a playlist) so it isn't requested again.
+
+        Returns:
+            TrackResult with the outcome of processing the song.
         """
-        song = self.info_provider.get_song(song_id)
-        audio_provider = self.audio_provider_class(self.audio_provider_settings)
+        result = TrackResult(song)
+        async with self._run():
+            await self._process_song(result)
+        return result
 
-        result = await audio_provider.search(song)
-        if result is None:
-            logger.warning("Song not found", extra={"songinfo": song.__dict__})
+    async def _process_song(self, track: TrackResult):
+        """Processes the song in the `TrackResult`, filling it in along the way. Raises if any step fails."""
+        if self._is_synced(track.song_id):
+            track.status = TrackStatus.SKIPPED
+            track.reason = "already synced"
+            return
+
+        song_id = track.song_id
+        with track.time("metadata"):
+            track.song = await self._resolve_song(track.song)
+        if track.song.id != song_id and self._is_synced(track.song.id):
+            track.status = TrackStatus.SKIPPED
+            track.reason = "already synced"
             return
-        downloaded = await audio_provider.download(result[0], self.temp_folder)
-        converted = await _convert_download(downloaded)
 
-        await self._get_lyrics(converted)
-        tag.tag_download(converted)
+        # Lyrics only need the song's metadata, so they're searched while the song is downloaded and converted
+        lyrics_task = asyncio.create_task(
+            self._timed(track, "lyrics", self._fetch_lyrics, track.song)
+        )
+        # Don't warn about the exception not being retrieved if the song fails before the lyrics are awaited
+        lyrics_task.add_done_callback(_retrieve_exception)
+        try:
+            async with self.audio_provider_pool.instance() as audio_provider:
+                with track.time("search"):
+                    result = await self._search(audio_provider, track.song)
+                if result is None:
+                    track.status = TrackStatus.NOT_FOUND
+                    track.reason = "no results from the audio provider"
+                    return
+                streaming = self._should_stream(audio_provider)
+                with track.time("download"):
+                    if streaming:
+                        # The song is converted while it's downloaded
+                        tags = await self._tag_data(track.song, lyrics_task)
+                        outputs = await self._stream_convert(
+                            audio_provider, result, tags
+                        )
+                    else:
+                        downloaded = await self._download(audio_provider, result)
+            if not streaming:
+                with track.time("convert"):
+                    tags = await self._tag_data(track.song, lyrics_task)
+                    outputs = await self._convert(downloaded, tags)
+
+            # Every output shares the same song object
+            outputs[0].song.lyrics = await lyrics_task
+        finally:
+            lyrics_task.cancel()
+
+        with track.time("tag"):
+            await self.retry_policy.call(None, self._tag_and_move_all, outputs)
+        track.outputs = outputs
+        track.download = outputs[0]
+        track.path = outputs[0].filename
+        track.status = TrackStatus.DONE
+
+    async def _search(
+        self, audio_provider: BaseAudioProvider, song: Song
+    ) -> Optional[AudioSearchResult]:
+        """Searches the song with the audio provider and returns the best result, or None if nothing was found. Uses
+        the match store first, if there is one."""
+        host = retry.host_name(audio_provider)
+        if self.match_store is not None:
+            stored = self.match_store.get(song, host)
+            if stored is not None:
+                return stored
+
+        result = await self.retry_policy.call(host, audio_provider.search, song)
+        if result is None:
+            logger.warning("Song not found", extra={"songinfo": asdict(song)})
+            return None
+
+        if self.match_store is not None:
+            self.match_store.put(song, host, result[0])
+        return result[0]
+
+    async def _download(
+        self, audio_provider: BaseAudioProvider, result: AudioSearchResult
+    ) -> Download:
+        return await self.retry_policy.call(
+            retry.host_name(audio_provider),
+            audio_provider.download,
+            result,
+            self.temp_folder,
+            self.conversion_scheduler.format,
+        )
+
+    async def _convert(
+        self, download: Download, tags: tag.TagData = None
+    ) -> list[Download]:
+        return await self.retry_policy.call(
+            None, self.conversion_scheduler.convert, download, True, tags
+        )
+
+    async def _tag_data(
+        self, song: Song, lyrics: asyncio.Future
+    ) -> Optional[tag.TagData]:
+        """Gathers the metadata FFmpeg embeds while converting the song, or returns None if `embed_tags` is off. The
+        lyrics are only included if they were already found, the conversion doesn't wait for them.
+        """
+        if not self.embed_tags:
+            return None
+
+        if lyrics.done() and not lyrics.cancelled() and lyrics.exception() is None:
+            song.lyrics = lyrics.result()
+        # Getting the cover image is blocking, run it outside the event loop
+        return await asyncio.get_running_loop().run_in_executor(
+            None, tag.TagData.from_song, song
+        )
+
+    def _should_stream(self, audio_provider: BaseAudioProvider) -> bool:
+        return self.stream_downloads and audio_provider.supports_streaming
+
+    async def _stream_convert(
+        self,
+        audio_provider: BaseAudioProvider,
+        result: AudioSearchResult,
+        tags: tag.TagData = None,
+    ) -> list[Download]:
+        """Streams the result from the audio provider straight into FFmpeg. The converted files are staged as hidden
+        files in the output folder, so moving them to their final names is only a rename.
+        """
+        self.output_folder.mkdir(parents=True, exist_ok=True)
+        # The empty file reserves the name, so songs resolving to the same video don't write to the same files
+        handle, staging_path = tempfile.mkstemp(
+            prefix=".downmixer-", dir=self.output_folder
+        )
+        os.close(handle)
+
+        async def stream_and_convert() -> list[Download]:
+            stream = await audio_provider.stream(
+                result, self.conversion_scheduler.format
+            )
+            return await self.conversion_scheduler.convert_stream(
+                result, stream, Path(staging_path), tags
+            )
+
+        try:
+            return await self.retry_policy.call(
+                retry.host_name(audio_provider), stream_and_convert
+            )
+        finally:
+            os.remove(staging_path)
+
+    def _tag_and_move_all(self, outputs: list[Download]):
+        """Tags and moves the converted file of each output format, updating their `filename` to the final path, and
+        records the first one in the manifest."""
+        for download in outputs:
+            # Files already moved by a previous attempt are moved onto themselves, which does nothing
+            download.filename = self._tag_and_move(download)
+
+        if self.manifest is not None:
+            self.manifest.record(outputs[0].song, outputs[0], outputs[0].filename)
+
+    def _tag_and_move(self, download: Download) -> Path:
+        """Tags the download and moves it to the output folder. Returns the final path of the file."""
+        tag.tag_download(download)
 
         new_name = (
-            utils.make_sane_filename(converted.song.title) + converted.filename.suffix
+            utils.make_sane_filename(download.song.title) + download.filename.suffix
         )
 
         self.output_folder.mkdir(parents=True, exist_ok=True)
         logger.debug(
-            f"Moving file from '{converted.filename}' to '{self.output_folder}'"
+            f"Moving file from '{download.filename}' to '{self.output_folder}'"
         )
-        shutil.move(converted.filename, self.output_folder.joinpath(new_name))
+        destination = self.output_folder.joinpath(new_name)
+        shutil.move(download.filename, destination)
+        return destination
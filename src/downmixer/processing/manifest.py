@@ -0,0 +1,226 @@
+"""Persistent record of the songs already synced to an output folder, so they can be skipped on the next run."""
+
+from __future__ import annotations
+
+import json
+import logging
+import sqlite3
+import threading
+import time
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Optional
+
+from downmixer.library import Song
+from downmixer.providers import Download
+
+logger = logging.getLogger("downmixer").getChild(__name__)
+
+MANIFEST_FILENAME = ".downmixer.db"
+
+
+@dataclass
+class ManifestEntry:
+    """Holds info about a song that was synced to the output folder.
+
+    Attributes:
+        song_id (str): ID of the song given by the info provider.
+        isrc (str, optional): ISRC of the song, if the info provider has one.
+        download_url (str): URL the audio was downloaded from.
+        path (Path): Path of the final file.
+        size (int): Size of the final file in bytes.
+        mtime (float): Modification time of the final file when it was recorded.
+        codec (str): Format of the final file, as a value from the `Format` enum.
+        synced_at (float): Timestamp of when the song was recorded.
+    """
+
+    song_id: str
+    isrc: Optional[str]
+    download_url: str
+    path: Path
+    size: int
+    mtime: float
+    codec: str
+    synced_at: float
+
+    def is_valid(self) -> bool:
+        """Checks if the file recorded still exists and wasn't modified since it was synced."""
+        try:
+            stat = self.path.stat()
+        except OSError:
+            return False
+        return stat.st_size == self.size and stat.st_mtime == self.mtime
+
+
+@dataclass
+class PlaylistState:
+    """Holds the state of a playlist from the last time it was synced.
+
+    Attributes:
+        playlist_id (str): ID of the playlist given by the info provider.
+        snapshot_id (str, optional): Version of the playlist given by the info provider, if it has one.
+        song_ids (list[str]): IDs of the songs in the playlist.
+        synced_at (float): Timestamp of when the playlist was recorded.
+    """
+
+    playlist_id: str
+    snapshot_id: Optional[str]
+    song_ids: list[str]
+    synced_at: float
+
+
+class SyncManifest:
+    def __init__(self, path: Path):
+        """SQLite database that records which songs were already processed into an output folder, keyed by the
+        info provider's song ID. Can be safely shared between threads.
+
+        Args:
+            path (Path): Path of the database file. Usually `MANIFEST_FILENAME` inside the output folder.
+        """
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(self.path, check_same_thread=False)
+        with self._connection:
+            self._connection.execute(
+                """CREATE TABLE IF NOT EXISTS songs (
+                    song_id TEXT PRIMARY KEY,
+                    isrc TEXT,
+                    download_url TEXT NOT NULL,
+                    path TEXT NOT NULL,
+                    size INTEGER NOT NULL,
+                    mtime REAL NOT NULL,
+                    codec TEXT NOT NULL,
+                    synced_at REAL NOT NULL
+                )"""
+            )
+            self._connection.execute(
+                """CREATE TABLE IF NOT EXISTS playlists (
+                    playlist_id TEXT PRIMARY KEY,
+                    snapshot_id TEXT,
+                    song_ids TEXT NOT NULL,
+                    synced_at REAL NOT NULL
+                )"""
+            )
+        logger.debug(f"Opened sync manifest at '{self.path}'")
+
+    @classmethod
+    def in_folder(cls, folder: Path) -> "SyncManifest":
+        """Opens (or creates) the manifest for the output folder given."""
+        return cls(Path(folder).joinpath(MANIFEST_FILENAME))
+
+    def get(self, song_id: str) -> Optional[ManifestEntry]:
+        """Returns the entry for the song ID, or None if it was never synced."""
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT song_id, isrc, download_url, path, size, mtime, codec, synced_at FROM songs "
+                "WHERE song_id = ?",
+                (song_id,),
+            ).fetchone()
+
+        if row is None:
+            return None
+        return ManifestEntry(
+            song_id=row[0],
+            isrc=row[1],
+            download_url=row[2],
+            path=Path(row[3]),
+            size=row[4],
+            mtime=row[5],
+            codec=row[6],
+            synced_at=row[7],
+        )
+
+    def is_synced(self, song_id: str, codec: str = None) -> bool:
+        """Checks if a song was already synced and its file is still valid.
+
+        Args:
+            song_id (str): ID of the song given by the info provider.
+            codec (str, optional): If given, the song is only considered synced if it was saved in this format.
+
+        Returns:
+            True if the song can be skipped, false otherwise.
+        """
+        entry = self.get(song_id)
+        if entry is None:
+            return False
+        if codec is not None and entry.codec != codec:
+            return False
+        return entry.is_valid()
+
+    def record(self, song: Song, download: Download, path: Path):
+        """Records a song as synced, storing the current size and modification time of its final file.
+
+        Args:
+            song (Song): Song that was processed.
+            download (Download): Download object of the song.
+            path (Path): Final path of the file in the output folder.
+        """
+        stat = path.stat()
+        with self._lock, self._connection:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO songs VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    song.id,
+                    song.isrc,
+                    download.download_url,
+                    str(path.absolute()),
+                    stat.st_size,
+                    stat.st_mtime,
+                    path.suffix[1:],
+                    time.time(),
+                ),
+            )
+
+    def get_playlist(self, playlist_id: str) -> Optional[PlaylistState]:
+        """Returns the state of the playlist from its last sync, or None if it was never synced."""
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT playlist_id, snapshot_id, song_ids, synced_at FROM playlists WHERE playlist_id = ?",
+                (playlist_id,),
+            ).fetchone()
+
+        if row is None:
+            return None
+        return PlaylistState(
+            playlist_id=row[0],
+            snapshot_id=row[1],
+            song_ids=json.loads(row[2]),
+            synced_at=row[3],
+        )
+
+    def record_playlist(
+        self, playlist_id: str, snapshot_id: Optional[str], song_ids: list[str]
+    ):
+        """Records the snapshot and songs of a playlist after it was synced.
+
+        Args:
+            playlist_id (str): ID of the playlist given by the info provider.
+            snapshot_id (str, optional): Version of the playlist given by the info provider. Storing None makes the
+                next sync go through every song of the playlist again.
+            song_ids (list[str]): IDs of the songs synced from the playlist.
+        """
+        with self._lock, self._connection:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO playlists VALUES (?, ?, ?, ?)",
+                (playlist_id, snapshot_id, json.dumps(song_ids), time.time()),
+            )
+
+    def is_in_other_playlist(self, song_id: str, playlist_id: str) -> bool:
+        """Checks if a song is part of any synced playlist other than the one given."""
+        with self._lock:
+            rows = self._connection.execute(
+                "SELECT song_ids FROM playlists WHERE playlist_id != ?",
+                (playlist_id,),
+            ).fetchall()
+        return any(song_id in json.loads(row[0]) for row in rows)
+
+    def remove(self, song_id: str):
+        """Removes a song from the manifest, so it's processed again on the next run."""
+        with self._lock, self._connection:
+            self._connection.execute("DELETE FROM songs WHERE song_id = ?", (song_id,))
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
@@ -0,0 +1,394 @@
+"""Staged processing pipeline, where each step of processing a song runs with its own number of workers."""
+
+from __future__ import annotations
+
+import asyncio
+import contextlib
+import logging
+import os
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import (
+    Type,
+    Optional,
+    Callable,
+    Awaitable,
+    NamedTuple,
+    Iterable,
+    AsyncIterator,
+)
+
+from downmixer.file_tools import Format
+from downmixer.library import Song
+from downmixer.processing import (
+    BasicProcessor,
+    TrackResult,
+    TrackStatus,
+    _retrieve_exception,
+)
+from downmixer.processing.retry import RetryPolicy
+from downmixer.providers import (
+    AudioSearchResult,
+    Download,
+    BaseInfoProvider,
+    BaseAudioProvider,
+    BaseLyricsProvider,
+)
+from downmixer.providers.matches import MatchStore
+from downmixer.providers.pool import ProviderPool
+
+logger = logging.getLogger("downmixer").getChild(__name__)
+
+
+@dataclass
+class StageWorkers:
+    """Number of concurrent workers for each stage of a `PipelineProcessor`. Network-bound stages (search, download
+    and lyrics) can usually go higher than the CPU-bound conversion stage, which defaults to the number of CPU cores.
+    """
+
+    search: int = 3
+    download: int = 3
+    convert: int = field(default_factory=lambda: os.cpu_count() or 1)
+    lyrics: int = 3
+    tag: int = 1
+
+
+@dataclass
+class _Track:
+    """Holds the state of a song as it moves through the pipeline."""
+
+    outcome: TrackResult
+    song: Optional[Song] = None
+    result: Optional[AudioSearchResult] = None
+    download: Optional[Download] = None
+    outputs: list[Download] = field(default_factory=list)
+    lyrics: Optional[asyncio.Future] = None
+
+    @property
+    def song_id(self) -> str:
+        return self.outcome.song_id
+
+
+class _Stage(NamedTuple):
+    name: str
+    func: Callable[[_Track], Awaitable[bool]]
+    workers: int
+    next: tuple[str, ...] = ()
+
+
+class PipelineProcessor(BasicProcessor):
+    def __init__(
+        self,
+        info_provider: BaseInfoProvider,
+        audio_provider_class: Type[BaseAudioProvider],
+        audio_provider_settings: str | None,
+        lyrics_provider: BaseLyricsProvider,
+        output_folder: Path,
+        temp_folder: Path,
+        threads: int = 3,
+        max_retries: int = 10,
+        max_encodes: int = None,
+        use_manifest: bool = False,
+        retry_policy: RetryPolicy = None,
+        match_store: MatchStore = None,
+        stream_downloads: bool = False,
+        output_format: Format = Format.MP3,
+        output_targets: list[tuple[Format, str]] = None,
+        embed_tags: bool = False,
+        stage_workers: StageWorkers = None,
+        queue_size: int = None,
+    ):
+        """Processor that splits the processing of a playlist into stages (search, download, convert, lyrics and
+        tag/move) joined by bounded [`asyncio.Queue`](https://docs.python.org/3/library/asyncio-queue.html)s. Each
+        stage has its own number of workers, so network-bound and CPU-bound work can overlap - a playlist takes
+        roughly as long as its slowest stage instead of the sum of all stages. The lyrics stage runs alongside the
+        download and convert stages, since it only needs the song's metadata.
+
+        Args:
+            info_provider (BaseInfoProvider): Class instance to use when searching an ID.
+            audio_provider_class (Type[BaseAudioProvider]): Class reference to use when downloading songs.
+            audio_provider_settings (str, optional): JSON formatted settings for the BaseAudioProvider.
+            lyrics_provider (BaseLyricsProvider): Class instance to use when downloading lyrics.
+            output_folder (str): Folder path where the final file will be placed.
+            temp_folder (str): Folder path where temporary files will be placed and removed from when processing
+                is finished.
+            threads (int): Amount of workers used for the search, download and lyrics stages if `stage_workers` is
+                not given.
+            max_retries (int): Amount of times a stage will be retried for a song before it's dropped. Ignored if
+                `retry_policy` is given.
+            max_encodes (int, optional): Maximum amount of FFmpeg conversions running at the same time. Defaults to
+                the number of CPU cores. With `stream_downloads`, also the maximum amount of songs being downloaded
+                at the same time, since each conversion lasts as long as its download.
+            use_manifest (bool): Keep a `SyncManifest` in the output folder and skip songs that were already synced
+                and whose files are still valid.
+            retry_policy (RetryPolicy, optional): Policy used to retry failed stages. Defaults to a `RetryPolicy` with
+                `max_retries`.
+            match_store (MatchStore, optional): Store of previous matches. Songs found in it skip searching, and new
+                matches are saved to it.
+            stream_downloads (bool): If the audio provider supports it, convert songs in the download stage as
+                they're downloaded, without saving them to `temp_folder` first. The convert stage then lets them
+                through.
+            output_format (Format): Format of the final files. Audio already in a codec the format can hold is
+                copied instead of encoded again.
+            output_targets (list[tuple[Format, str]], optional): Formats and bitrates to convert every song to, all
+                in the same FFmpeg run. Replaces `output_format` if given.
+            embed_tags (bool): Have FFmpeg write the song's metadata and cover image while converting, so the tag
+                stage only edits the tags in place. Lyrics are embedded if the lyrics stage finished first.
+            stage_workers (StageWorkers, optional): Number of workers for each stage.
+            queue_size (int, optional): Maximum amount of songs waiting between two stages. Defaults to twice the
+                highest number of workers.
+        """
+        super().__init__(
+            info_provider,
+            audio_provider_class,
+            audio_provider_settings,
+            lyrics_provider,
+            output_folder,
+            temp_folder,
+            threads,
+            max_retries,
+            max_encodes,
+            use_manifest,
+            retry_policy,
+            match_store,
+            stream_downloads,
+            output_format,
+            output_targets,
+            embed_tags,
+        )
+
+        if stage_workers is None:
+            stage_workers = StageWorkers(
+                search=threads, download=threads, lyrics=threads
+            )
+        self.stage_workers = stage_workers
+
+        if queue_size is None:
+            queue_size = 2 * max(
+                stage_workers.search,
+                stage_workers.download,
+                stage_workers.convert,
+                stage_workers.lyrics,
+                stage_workers.tag,
+            )
+        self.queue_size = queue_size
+
+        # Search and download workers each hold one audio provider instance at a time
+        self.audio_provider_pool = ProviderPool(
+            audio_provider_class,
+            audio_provider_settings,
+            stage_workers.search + stage_workers.download,
+        )
+
+    async def iter_songs(
+        self, songs: Iterable[str | Song]
+    ) -> AsyncIterator[TrackResult]:
+        """Passes the songs given through all stages of the pipeline, yielding a `TrackResult` for each one as soon
+        as it leaves the pipeline. Results wait in a queue of `queue_size`, so if the consumer falls behind the whole
+        pipeline slows down with it. Stopping the iteration cancels the pipeline.
+
+        Args:
+            songs (Iterable[str | Song]): IDs or `Song` objects to be processed. Can be a lazy iterable.
+
+        Yields:
+            TrackResult of each song, in the order they finish.
+        """
+        results = asyncio.Queue(self.queue_size)
+
+        async def run():
+            try:
+                await self.run_pipeline(songs, results)
+            except asyncio.CancelledError:
+                # The consumer stopped reading, so waiting for room in the queue would never end
+                with contextlib.suppress(asyncio.QueueFull):
+                    results.put_nowait(None)
+                raise
+            except Exception:
+                await results.put(None)
+                raise
+            else:
+                await results.put(None)
+
+        async with self._run():
+            runner = asyncio.create_task(run())
+            try:
+                while True:
+                    result = await results.get()
+                    if result is None:
+                        break
+                    yield result
+                # Raise any exception from the pipeline itself
+                await runner
+            finally:
+                runner.cancel()
+
+    async def run_pipeline(
+        self, songs: Iterable[str | Song], results: asyncio.Queue = None
+    ):
+        """Feeds the songs into the first stage and waits for all stages to finish.
+
+        Args:
+            songs (Iterable[str | Song]): IDs of the songs to be processed, or `Song` objects already retrieved from
+                the info provider.
+            results (asyncio.Queue, optional): Queue where the `TrackResult` of each song is put once it leaves the
+                pipeline.
+        """
+        # Lyrics only need the song's metadata, so they branch off after the search and are joined back in the tag
+        # stage. Stages are listed in the order they're shut down.
+        stages = [
+            _Stage(
+                "search",
+                self._search_stage,
+                self.stage_workers.search,
+                ("download", "lyrics"),
+            ),
+            _Stage("lyrics", self._lyrics_stage, self.stage_workers.lyrics),
+            _Stage(
+                "download",
+                self._download_stage,
+                self.stage_workers.download,
+                ("convert",),
+            ),
+            _Stage(
+                "convert", self._convert_stage, self.stage_workers.convert, ("tag",)
+            ),
+            _Stage("tag", self._tag_stage, self.stage_workers.tag),
+        ]
+        queues = {stage.name: asyncio.Queue(self.queue_size) for stage in stages}
+
+        workers = []
+        for stage in stages:
+            outboxes = [queues[x] for x in stage.next]
+            workers.append(
+                [
+                    asyncio.create_task(
+                        self._worker(stage, queues[stage.name], outboxes, results)
+                    )
+                    for _ in range(max(stage.workers, 1))
+                ]
+            )
+
+        try:
+            for song in songs:
+                track = _Track(
+                    outcome=TrackResult(song),
+                    song=song if isinstance(song, Song) else None,
+                )
+
+                if self._is_synced(track.song_id):
+                    track.outcome.status = TrackStatus.SKIPPED
+                    track.outcome.reason = "already synced"
+                    await self._finish(track, results)
+                    continue
+                await queues[stages[0].name].put(track)
+
+            # Workers of a stage only stop after every song before the sentinels went through, so shutting down stages in
+            # order guarantees nothing is left behind in the queues.
+            for i, stage in enumerate(stages):
+                for _ in workers[i]:
+                    await queues[stage.name].put(None)
+                await asyncio.gather(*workers[i])
+                logger.debug(f"Stage '{stage.name}' finished")
+        finally:
+            # Only does anything if the pipeline was cancelled before all workers stopped
+            for task in [t for stage_workers in workers for t in stage_workers]:
+                task.cancel()
+
+    async def _worker(
+        self,
+        stage: _Stage,
+        inbox: asyncio.Queue,
+        outboxes: list[asyncio.Queue],
+        results: asyncio.Queue | None,
+    ):
+        while True:
+            track: _Track | None = await inbox.get()
+            if track is None:
+                return
+
+            try:
+                with track.outcome.time(stage.name):
+                    keep_going = await stage.func(track)
+            except Exception as e:
+                # Stages already retry according to the retry policy, drop the song
+                track.outcome.fail(e)
+                logger.error(
+                    f"Failed stage '{stage.name}' for song '{track.song_id}' ({track.outcome.reason})",
+                    exc_info=e,
+                )
+                keep_going = False
+
+            if keep_going:
+                for outbox in outboxes:
+                    await outbox.put(track)
+            else:
+                await self._finish(track, results)
+
+    @staticmethod
+    async def _finish(track: _Track, results: asyncio.Queue | None):
+        if track.song is not None:
+            track.outcome.song = track.song
+        if results is not None:
+            await results.put(track.outcome)
+
+    # Stages return True if the song should go on to the next stages, or False if it's finished.
+
+    async def _search_stage(self, track: _Track) -> bool:
+        logger.debug(f"Processing song '{track.song_id}'")
+        if track.song is None:
+            track.song = await self._resolve_song(track.song_id)
+        async with self.audio_provider_pool.instance() as audio_provider:
+            track.result = await self._search(audio_provider, track.song)
+
+        if track.result is None:
+            track.outcome.status = TrackStatus.NOT_FOUND
+            track.outcome.reason = "no results from the audio provider"
+            return False
+
+        track.lyrics = asyncio.get_running_loop().create_future()
+        # Don't warn about the exception not being retrieved if the song fails before the lyrics are awaited
+        track.lyrics.add_done_callback(_retrieve_exception)
+        return True
+
+    async def _download_stage(self, track: _Track) -> bool:
+        async with self.audio_provider_pool.instance() as audio_provider:
+            if self._should_stream(audio_provider):
+                tags = await self._tag_data(track.song, track.lyrics)
+                track.outputs = await self._stream_convert(
+                    audio_provider, track.result, tags
+                )
+            else:
+                track.download = await self._download(audio_provider, track.result)
+        return True
+
+    async def _convert_stage(self, track: _Track) -> bool:
+        if len(track.outputs) == 0:
+            tags = await self._tag_data(track.song, track.lyrics)
+            track.outputs = await self._convert(track.download, tags)
+        return True
+
+    async def _lyrics_stage(self, track: _Track) -> bool:
+        # Lyrics are optional, so the song goes on without them if they fail. The stage never raises either, since
+        # the song would be reported as failed here while the other branch keeps processing it.
+        lyrics = None
+        try:
+            lyrics = await self._fetch_lyrics(track.song)
+        except Exception as e:
+            logger.warning(f"Failed getting lyrics for '{track.song_id}'", exc_info=e)
+        finally:
+            # The tag stage waits for the lyrics, resolve them on every path (even cancellation) so it never hangs
+            if not track.lyrics.done():
+                track.lyrics.set_result(lyrics)
+        return True
+
+    async def _tag_stage(self, track: _Track) -> bool:
+        # Every output shares the same song object
+        track.outputs[0].song.lyrics = await track.lyrics
+
+        # Tagging and moving files is blocking, the retry policy runs it outside the event loop
+        await self.retry_policy.call(None, self._tag_and_move_all, track.outputs)
+        track.outcome.outputs = track.outputs
+        track.outcome.download = track.outputs[0]
+        track.outcome.path = track.outputs[0].filename
+        track.outcome.status = TrackStatus.DONE
+        return False
@@ -0,0 +1,361 @@
+"""Retry policy used by the processors: classifies errors, backs off exponentially with jitter and pauses every worker
+using an upstream host when that host keeps failing."""
+
+from __future__ import annotations
+
+import asyncio
+import functools
+import inspect
+import logging
+import random
+import re
+import socket
+import time
+import urllib.error
+from enum import Enum
+from typing import Any, Callable, Optional
+
+import aiohttp
+import requests
+import yt_dlp.utils
+from yt_dlp.networking.exceptions import TransportError
+
+from downmixer import utils
+from downmixer.providers.ratelimit import run_blocking
+
+logger = logging.getLogger("downmixer").getChild(__name__)
+
+
+class ErrorClass(Enum):
+    """Classes of errors, which decide if and how an operation is retried.
+
+    ## Transient
+    Network errors, timeouts and server errors. Retried with exponential backoff.
+
+    ## Rate limit
+    The host refused the request because too many were sent. Retried after the `Retry-After` time given by the host, or
+    a longer backoff if none was given.
+
+    ## Not found
+    The resource doesn't exist on the host. Not retried.
+
+    ## Permanent
+    Errors that won't go away by trying again, like invalid data, a corrupt file or a programming error, and any
+    error not known to be one of the others. Not retried.
+    """
+
+    TRANSIENT = 1
+    RATE_LIMIT = 2
+    NOT_FOUND = 3
+    PERMANENT = 4
+
+
+# Only errors of the network or the host are worth trying again, everything else (like FFmpeg failing on a bad
+# download or mutagen on a corrupt file) fails the same way every time
+_TRANSIENT_EXCEPTIONS = (
+    ConnectionError,
+    TimeoutError,
+    asyncio.TimeoutError,
+    socket.gaierror,
+    urllib.error.URLError,
+    requests.exceptions.ConnectionError,
+    requests.exceptions.Timeout,
+    requests.exceptions.ChunkedEncodingError,
+    aiohttp.ClientConnectionError,
+    aiohttp.ClientPayloadError,
+    TransportError,
+    yt_dlp.utils.ContentTooShortError,
+)
+
+# Only messages about the resource itself, generic ones like "Service Unavailable" are server errors
+_NOT_FOUND_MESSAGES = (
+    "not found",
+    "video unavailable",
+    "video is unavailable",
+    "private video",
+    "has been removed",
+)
+
+# Status codes in messages of clients that don't keep them as an attribute, like "HTTP 503" from ytmusicapi or
+# "HTTP Error 404" from urllib and yt-dlp
+_STATUS_MESSAGE = re.compile(r"\bhttp(?: error)? (\d{3})\b", re.IGNORECASE)
+
+
+def _exception_chain(exception: BaseException, depth: int = 5) -> list[BaseException]:
+    """Returns the exception followed by the exceptions wrapped by it, like the `exc_info` of yt-dlp's
+    `DownloadError`, the `cause` of its `ExtractorError` or the standard `__cause__`."""
+    chain = []
+    current = exception
+    while current is not None and len(chain) < depth and current not in chain:
+        chain.append(current)
+        wrapped = getattr(current, "exc_info", None)
+        if isinstance(wrapped, tuple) and len(wrapped) > 1:
+            current = wrapped[1]
+        elif isinstance(getattr(current, "cause", None), BaseException):
+            current = current.cause
+        else:
+            current = current.__cause__ or current.__context__
+    return chain
+
+
+def _get_status(exception: BaseException) -> Optional[int]:
+    """Looks for an HTTP status code in the exception or the ones it wraps, first in their attributes and then in
+    their messages."""
+    chain = _exception_chain(exception)
+    for e in chain:
+        response = getattr(e, "response", None)
+        for value in (
+            getattr(e, "http_status", None),
+            getattr(e, "status", None),
+            getattr(e, "status_code", None),
+            getattr(response, "status_code", None),
+            getattr(response, "status", None),
+        ):
+            if isinstance(value, int):
+                return value
+
+    for e in chain:
+        found = _STATUS_MESSAGE.search(str(e))
+        if found is not None:
+            return int(found.group(1))
+    return None
+
+
+def get_retry_after(exception: BaseException) -> Optional[float]:
+    """Returns the seconds from the `Retry-After` header of the response that caused the exception, if there is one.
+
+    Args:
+        exception (BaseException): Exception raised by an HTTP client.
+
+    Returns:
+        float: Amount of seconds to wait, or None if the header isn't available.
+    """
+    for e in _exception_chain(exception):
+        response = getattr(e, "response", None)
+        for headers in (
+            getattr(e, "headers", None),
+            getattr(response, "headers", None),
+        ):
+            if headers is None:
+                continue
+            try:
+                value = headers.get("Retry-After")
+            except AttributeError:
+                continue
+            seconds = utils.parse_retry_after(value)
+            if seconds is not None:
+                return seconds
+    return None
+
+
+def classify(exception: BaseException) -> ErrorClass:
+    """Decides the `ErrorClass` of an exception, based on the HTTP status code it carries (if any), its type and its
+    message. Only network errors, timeouts and server errors are transient, unknown errors are permanent.
+
+    Args:
+        exception (BaseException): Exception to classify.
+
+    Returns:
+        The class of the error.
+    """
+    status = _get_status(exception)
+    if status is not None:
+        if status == 429:
+            return ErrorClass.RATE_LIMIT
+        elif status in (404, 410):
+            return ErrorClass.NOT_FOUND
+        elif status == 408 or status >= 500:
+            return ErrorClass.TRANSIENT
+        elif 400 <= status < 500:
+            return ErrorClass.PERMANENT
+
+    message = str(exception).lower()
+    if "http error 429" in message or "too many requests" in message:
+        return ErrorClass.RATE_LIMIT
+
+    for e in _exception_chain(exception):
+        # yt-dlp marks errors that are the fault of the video (e.g. it was removed) as expected
+        if getattr(e, "expected", False) or any(
+            x in str(e).lower() for x in _NOT_FOUND_MESSAGES
+        ):
+            return ErrorClass.NOT_FOUND
+
+    if any(isinstance(e, _TRANSIENT_EXCEPTIONS) for e in _exception_chain(exception)):
+        return ErrorClass.TRANSIENT
+    return ErrorClass.PERMANENT
+
+
+def host_name(provider: Any) -> str:
+    """Returns the name used to identify the upstream host of a provider instance."""
+    return getattr(provider, "provider_name", None) or type(provider).__name__
+
+
+class CircuitBreaker:
+    def __init__(
+        self, host: str, failure_threshold: int = 5, reset_timeout: float = 30.0
+    ):
+        """Stops every worker from calling a host after it failed `failure_threshold` times in a row, until
+        `reset_timeout` seconds pass (or the time the host asked for in a `Retry-After` header). Once the timeout
+        is over, calls go through again, but a single failure opens the circuit again.
+
+        Args:
+            host (str): Name of the host, used for logging.
+            failure_threshold (int): Consecutive transient or rate limit failures that open the circuit.
+            reset_timeout (float): Seconds the circuit stays open.
+        """
+        self.host = host
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+
+        self.failures = 0
+        self.open_until = 0.0
+
+    @property
+    def is_open(self) -> bool:
+        """bool: True if calls to the host are paused."""
+        return time.monotonic() < self.open_until
+
+    async def wait(self):
+        """Waits until the circuit is closed."""
+        while self.is_open:
+            await asyncio.sleep(self.open_until - time.monotonic())
+
+    def record_success(self):
+        self.failures = 0
+
+    def record_failure(self, error_class: ErrorClass, retry_after: float = None):
+        """Counts a failure from the host. Only transient and rate limit errors count, since the other classes are
+        about the song and not the host."""
+        if error_class not in (ErrorClass.TRANSIENT, ErrorClass.RATE_LIMIT):
+            return
+
+        self.failures += 1
+        if self.failures >= self.failure_threshold:
+            timeout = max(retry_after or 0.0, self.reset_timeout)
+            # Half-open: the next failure after the timeout opens the circuit again
+            self.failures = self.failure_threshold - 1
+        elif retry_after is not None:
+            # The host told us when to come back, no point in letting other workers try before that
+            timeout = retry_after
+        else:
+            return
+
+        self.open_until = max(self.open_until, time.monotonic() + timeout)
+        logger.warning(
+            f"Too many failures from '{self.host}', pausing requests for {timeout:.1f} seconds"
+        )
+
+
+class RetryPolicy:
+    def __init__(
+        self,
+        max_retries: int = 10,
+        base_delay: float = 1.0,
+        max_delay: float = 60.0,
+        rate_limit_delay: float = 10.0,
+        failure_threshold: int = 5,
+        reset_timeout: float = 30.0,
+    ):
+        """Retries operations according to the class of error they raise, with exponential backoff and full jitter.
+        Each upstream host gets its own `CircuitBreaker`, shared by everything calling that host through this
+        policy.
+
+        Args:
+            max_retries (int): Maximum amount of retries for a single operation.
+            base_delay (float): Delay in seconds before the first retry. Doubles on every retry.
+            max_delay (float): Maximum delay in seconds between retries.
+            rate_limit_delay (float): Minimum delay in seconds after a rate limit error with no `Retry-After` header.
+            failure_threshold (int): Consecutive failures of a host that open its circuit breaker.
+            reset_timeout (float): Seconds a circuit breaker stays open.
+        """
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.rate_limit_delay = rate_limit_delay
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+
+        self.breakers: dict[str, CircuitBreaker] = {}
+
+    def breaker(self, host: str) -> CircuitBreaker:
+        """Returns the circuit breaker of a host, creating it if needed."""
+        if host not in self.breakers:
+            self.breakers[host] = CircuitBreaker(
+                host, self.failure_threshold, self.reset_timeout
+            )
+        return self.breakers[host]
+
+    def should_retry(self, error_class: ErrorClass, attempt: int) -> bool:
+        """Checks if an operation should be tried again after failing `attempt` times with the error class given."""
+        if error_class in (ErrorClass.NOT_FOUND, ErrorClass.PERMANENT):
+            return False
+        return attempt < self.max_retries
+
+    def delay(
+        self, attempt: int, error_class: ErrorClass, retry_after: float = None
+    ) -> float:
+        """Returns the seconds to wait before the next attempt. Uses the `Retry-After` value if the host gave one,
+        otherwise a random delay between zero and the exponential backoff ("full jitter").
+        """
+        if retry_after is not None:
+            return retry_after
+
+        backoff = min(self.max_delay, self.base_delay * 2**attempt)
+        delay = random.uniform(0, backoff)
+        if error_class == ErrorClass.RATE_LIMIT:
+            delay = max(delay, self.rate_limit_delay)
+        return delay
+
+    async def call(self, host: str | None, func: Callable, *args, **kwargs) -> Any:
+        """Calls the function (synchronous or asynchronous) with the arguments given, retrying it according to this
+        policy. Waits for the host's circuit breaker to close before every attempt. Synchronous functions run outside
+        the event loop, so they don't stall every other song: calls to a host in the thread pool of
+        `ratelimit.run_blocking`, since they may wait for a rate limiter, and local ones in the default executor.
+
+        Args:
+            host (str, optional): Name of the upstream host the function talks to. Local operations can pass None to
+                skip the circuit breaker.
+            func (Callable): Function to call.
+
+        Returns:
+            Whatever `func` returns.
+        """
+        breaker = self.breaker(host) if host is not None else None
+
+        attempt = 0
+        while True:
+            if breaker is not None:
+                await breaker.wait()
+
+            try:
+                if inspect.iscoroutinefunction(func):
+                    result = func(*args, **kwargs)
+                elif host is not None:
+                    result = await run_blocking(func, *args, **kwargs)
+                else:
+                    result = await asyncio.get_running_loop().run_in_executor(
+                        None, functools.partial(func, *args, **kwargs)
+                    )
+                if inspect.isawaitable(result):
+                    result = await result
+            except Exception as e:
+                error_class = classify(e)
+                retry_after = get_retry_after(e)
+                if breaker is not None:
+                    breaker.record_failure(error_class, retry_after)
+
+                if not self.should_retry(error_class, attempt):
+                    raise
+
+                delay = self.delay(attempt, error_class, retry_after)
+                logger.warning(
+                    f"{error_class.name.lower()} error calling '{getattr(func, '__qualname__', func)}', retrying in "
+                    f"{delay:.1f} seconds ({self.max_retries - attempt} left)",
+                    exc_info=e,
+                )
+                await asyncio.sleep(delay)
+                attempt += 1
+            else:
+                if breaker is not None:
+                    breaker.record_success()
+                return result
@@ -8,9 +8,9 @@ import sys
 from dataclasses import dataclass
 from enum import Enum
 from pathlib import Path
-from typing import Optional, Type
+from typing import Optional, Type, AsyncIterator
 
-from downmixer.file_tools import AudioCodecs
+from downmixer.file_tools import AudioCodecs, Format
 from downmixer.library import Song, Playlist
 from downmixer.matching import MatchResult, MatchQuality
 
@@ -104,12 +104,31 @@ class Download(AudioSearchResult):
         )
 
 
+@dataclass
+class AudioStream:
+    """Audio data of a search result being downloaded, handed over in chunks as they arrive instead of being saved to
+    a file first.
+
+    Attributes:
+        chunks (AsyncIterator[bytes]): The raw bytes of the source file, in order.
+        bitrate (float): The source's bitrate in kbps.
+        audio_codec (AudioCodecs): One of the supported audio codecs from `AudioCodecs` enum.
+        container (str, optional): Container format of the source (e.g. "webm"), so FFmpeg doesn't need to guess it.
+    """
+
+    chunks: AsyncIterator[bytes]
+    bitrate: float
+    audio_codec: AudioCodecs
+    container: Optional[str] = None
+
+
 class BaseAudioProvider:
     """
     Base class for all audio providers. Defines the interface that any audio provider in Downmixer should use.
     """
 
     provider_name = ""
+    supports_streaming = False
 
     def __init__(self, options: dict = None):
         """Initializes the provider.
@@ -133,19 +152,37 @@ class BaseAudioProvider:
         raise NotImplementedError
 
     async def download(
-        self, result: AudioSearchResult, path: Path
+        self, result: AudioSearchResult, path: Path, output_format: Format = None
     ) -> Optional[Download]:
         """Downloads, using this provider, a search result to the path specified.
 
         Args:
             result (AudioSearchResult): The `AudioSearchResult` that matches with this provider class.
             path (Path): The folder (not filename) in which the file will be downloaded.
+            output_format (Format, optional): Format the download will be converted to. Providers with many versions
+                of the same audio should pick the one that's the least work to convert, ideally one with a codec the
+                format can hold without encoding again (see `Format.can_copy`).
 
         Returns:
             Download object with the downloaded file information.
         """
         raise NotImplementedError
 
+    async def stream(
+        self, result: AudioSearchResult, output_format: Format = None
+    ) -> AudioStream:
+        """Starts downloading a search result, without saving it to disk. Only available if `supports_streaming` is
+        True.
+
+        Args:
+            result (AudioSearchResult): The `AudioSearchResult` that matches with this provider class.
+            output_format (Format, optional): Format the stream will be converted to, same as in `download`.
+
+        Returns:
+            AudioStream yielding the file's bytes as they're downloaded.
+        """
+        raise NotImplementedError
+
 
 class BaseLyricsProvider:
     """
@@ -186,6 +223,16 @@ class BaseLyricsProvider:
         """
         raise NotImplementedError
 
+    async def close(self):
+        """Closes any connections kept open by the provider. Does nothing by default."""
+        pass
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
 
 class NotConnectedException(Exception):
     pass
@@ -200,6 +247,7 @@ class BaseInfoProvider:
     Deezer, Apple Music, etc. Used to get the user's library and read the data of that song on said platform.
     """
 
+    provider_name = ""
     connected = False
 
     def __init__(self, options: dict = None):
@@ -246,10 +294,14 @@ class BaseInfoProvider:
 
         pass
 
-    def get_all_playlist_songs(self, playlist_id: str) -> list[Song]:
+    def get_all_playlist_songs(
+        self, playlist_id: str, snapshot_id: str = None
+    ) -> list[Song]:
         """Retrieves the all the songs from a playlist as a list.
         Args:
             playlist_id (str): A string containing a valid ID for the provider.
+            snapshot_id (str, optional): The playlist's current version from `get_playlist_snapshot`, if the caller
+                already has it, so the provider doesn't need to request it again.
 
         Returns:
             User's playlists as a list of Song objects.
@@ -266,6 +318,18 @@ class BaseInfoProvider:
 
         pass
 
+    def get_playlist_snapshot(self, playlist_id: str) -> Optional[str]:
+        """Retrieves a value that changes every time the playlist is modified, like Spotify's `snapshot_id`, with as
+        little data as possible. Used to skip playlists that didn't change since they were last synced.
+
+        Args:
+            playlist_id (str): A string containing a valid ID for the provider.
+
+        Returns:
+            The playlist's current version, or None if the provider doesn't support it.
+        """
+        return None
+
     def get_all_user_playlists(self) -> list[Playlist]:
         """Retrieves the all the user's playlists in a list.
 
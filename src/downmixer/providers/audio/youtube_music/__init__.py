@@ -4,17 +4,30 @@ import asyncio
 import functools
 import json
 import logging
+import threading
 from http.cookiejar import CookieJar
 from pathlib import Path
-from typing import Optional, Any, Callable
+from typing import Optional, Any, Callable, AsyncIterator
 
+import aiohttp
 import yt_dlp
 import ytmusicapi
 
 from downmixer import matching, utils
-from downmixer.file_tools import AudioCodecs
+from downmixer.file_tools import AudioCodecs, Format
 from downmixer.library import Artist, Album, Song
-from downmixer.providers import BaseAudioProvider, AudioSearchResult, Download
+from downmixer.matching import MatchQuality, MatchResult
+from downmixer.providers import (
+    BaseAudioProvider,
+    AudioSearchResult,
+    Download,
+    AudioStream,
+)
+from downmixer.providers.ratelimit import (
+    get_rate_limiter,
+    RateLimitedSession,
+    run_blocking,
+)
 
 logger = logging.getLogger("downmixer").getChild(__name__)
 
@@ -74,7 +87,7 @@ def song_from_ytmusic(data: dict[str, Any]) -> Song:
 
 
 def search_result_from_ytmusic(
-    original_song: Song, result_song: Song
+    original_song: Song, result_song: Song, match: MatchResult = None
 ) -> AudioSearchResult:
     """Create an AudioSearchResult instance from a dict provided by the YouTube Music API search function. Sadly the only
     metadata of use form the search results is the title of the artist. More info on the result's schema [here](
@@ -83,6 +96,7 @@ def search_result_from_ytmusic(
     Args:
         original_song (Song): Instance of a song from Spotify that will be compared against this search result.
         result_song (Song): Song extracted from the search result info.
+        match (MatchResult, optional): Match between both songs, if it was already calculated.
 
     Returns:
         AudioSearchResult from YT Music.
@@ -91,7 +105,7 @@ def search_result_from_ytmusic(
         provider="ytmusic",
         _original_song=original_song,
         _result_song=result_song,
-        match=matching.match(original_song, result_song),
+        match=match or matching.match(original_song, result_song),
         download_url=result_song.url,
     )
 
@@ -139,13 +153,38 @@ async def _run_in_loop(func: Callable, kwargs: dict) -> Any:
 
 class YouTubeMusicAudioProvider(BaseAudioProvider):
     provider_name = "youtube-music"
+    supports_streaming = True
+
+    # Source formats that can be copied into each output format without encoding, falling back to the best audio
+    format_selectors = {
+        Format.OPUS: "bestaudio[acodec=opus]/bestaudio",
+        Format.M4A: "bestaudio[ext=m4a]/bestaudio",
+    }
+
+    # YouTube throttles requests for whole files, so streams are requested in ranges like yt-dlp does
+    stream_chunk_size = 10 * 1024 * 1024
 
     def __init__(self, options: dict = None):
-        default_options = {"encoding": "UTF-8", "format": "bestaudio"}
+        default_options = {
+            "encoding": "UTF-8",
+            "format": "bestaudio",
+            "min_match_quality": None,
+        }
         options = utils.merge_dicts_with_priority(default_options, options)
         super().__init__(options)
 
+        # Results that can't reach this quality are dropped while they're matched, without being scored in full
+        self.min_match_quality = (
+            MatchQuality[options["min_match_quality"].upper()]
+            if options["min_match_quality"]
+            else None
+        )
+
+        # Shared by all instances, so pooled providers don't multiply the request rate
+        self.limiter = get_rate_limiter(self.provider_name, options, rate=5, burst=5)
+
         self.youtube_dl = yt_dlp.YoutubeDL(self.options)
+        self._download_lock = threading.Lock()
         logger.debug(f"Initialized YoutubeDL client with options: {self.options}")
 
         auth_headers = _get_auth_headers(self.youtube_dl.cookiejar)
@@ -154,52 +193,107 @@ class YouTubeMusicAudioProvider(BaseAudioProvider):
         # For some reason some songs like 70tjloUDVlGYkapPPTWRxU weren't found via ISRC if the language param was not
         # specified 🤷🏻‍♀️. Selecting English bought a completely fucked up result too. I copied "de" (aka German)
         # from spotDL
-        self.client = ytmusicapi.YTMusic(auth=auth_headers, language="de")
+        self.client = ytmusicapi.YTMusic(
+            auth=auth_headers,
+            language="de",
+            requests_session=RateLimitedSession(self.limiter),
+        )
+
+    def _search_query(self, query: str) -> list[dict[str, Any]]:
+        logger.debug(f"Searching query '{query}'")
+        return self.client.search(query, filter="songs", ignore_spelling=True)
+
+    def _to_results(
+        self,
+        song: Song,
+        results: list[dict[str, Any]],
+        min_quality: MatchQuality = None,
+    ) -> list[AudioSearchResult]:
+        result_objects = []
+        result_songs = [song_from_ytmusic(r) for r in results]
+        for result_song, match in matching.match_many(
+            song, result_songs, min_quality or self.min_match_quality
+        ):
+            search_result = search_result_from_ytmusic(song, result_song, match)
+            result_objects.append(search_result)
+            logger.debug(
+                f"Found song '{result_song.title}' with URL {result_song.url}, match value {search_result.match.sum}"
+            )
+        return result_objects
 
     async def search(self, song: Song) -> Optional[list[AudioSearchResult]]:
         logger.info(f"Initializing search for song '{song.title}' with URI {song.id}")
+        results = []
         if song.isrc:
-            query = song.isrc
-        else:
-            query = song.title
-
-        # TODO: redo search if ISRC isn't found
-        logger.debug(f"Searching query '{query}'")
-        results = self.client.search(query, filter="songs", ignore_spelling=True)
+            results = await run_blocking(self._search_query, song.isrc)
+
+        # YT Music results don't include an ISRC, so the results of searching one are scored like any other, and
+        # only kept if they're good enough to skip searching by title
+        isrc_quality = MatchQuality.GOOD
+        if (
+            self.min_match_quality is not None
+            and self.min_match_quality.value > isrc_quality.value
+        ):
+            isrc_quality = self.min_match_quality
+        result_objects = self._to_results(song, results, isrc_quality)
+        best = max((x.match.sum for x in result_objects), default=None)
+        if best is None or best < MatchQuality.GOOD.value:
+            # ISRCs aren't always found, so fall back to searching the title, with and without the artist, at once
+            logger.debug(
+                f"No good results for ISRC, searching by title (best score: {best})"
+            )
+            queries = list(dict.fromkeys([song.name, song.title]))
+            fallback_results = await asyncio.gather(
+                *[run_blocking(self._search_query, q) for q in queries]
+            )
+            for query_results in fallback_results:
+                result_objects += self._to_results(song, query_results)
 
-        if len(results) == 0:
+        if len(result_objects) == 0:
             logger.warning("Search returned no results")
             return None
 
-        result_objects = []
-        for r in results:
-            result_song = song_from_ytmusic(r)
-            search_result = search_result_from_ytmusic(song, result_song)
-            result_objects.append(search_result)
-            logger.debug(
-                f"Found song '{result_song.title}' with URL {result_song.url}, match value {search_result.match.sum}"
-            )
+        # The same song is often returned by more than one query, keep only one of each
+        unique_results = list({x.download_url: x for x in result_objects}.values())
 
         ordered_results = sorted(
-            result_objects, reverse=True, key=lambda x: x.match.sum
+            unique_results, reverse=True, key=lambda x: x.match.sum
         )
         logger.debug(f"Ordered {len(ordered_results)} results")
         return ordered_results
 
+    def _format_selector(self, output_format: Format | None) -> str:
+        """Returns the yt-dlp format selector that best fits the output format. Custom formats set in the options
+        are always used as is."""
+        if self.options["format"] != "bestaudio" or output_format is None:
+            return self.options["format"]
+        return self.format_selectors.get(output_format, self.options["format"])
+
+    def _download_to(
+        self, url: str, path: Path, output_format: Format = None
+    ) -> dict[str, Any]:
+        """Downloads the URL to the folder given. The output path and format are stored in the shared YoutubeDL
+        params, so the lock keeps concurrent downloads with the same instance from writing to each other's folders.
+        """
+        with self._download_lock:
+            # Set output path and format of YoutubeDL on the fly
+            self.youtube_dl.params["outtmpl"]["default"] = (
+                str(path.absolute()) + "/%(id)s.%(ext)s"
+            )
+            self.youtube_dl.params["format"] = self._format_selector(output_format)
+            return self.youtube_dl.extract_info(url, download=True)
+
     async def download(
-        self, result: AudioSearchResult, path: Path
+        self, result: AudioSearchResult, path: Path, output_format: Format = None
     ) -> Optional[Download]:
         logger.info(
             f"Starting download for search result '{result.song.title}' with URL {result.download_url}"
         )
 
-        # Set output path of YoutubeDL on the fly
-        self.youtube_dl.params["outtmpl"]["default"] = (
-            str(path.absolute()) + "/%(id)s.%(ext)s"
-        )
-        url = result.download_url
+        await self.limiter.acquire_async()
         metadata = await _run_in_loop(
-            self.youtube_dl.extract_info, {"url": url, "download": True}
+            self._download_to,
+            {"url": result.download_url, "path": path, "output_format": output_format},
         )
         logger.info("Finished downloading")
 
@@ -213,6 +307,68 @@ class YouTubeMusicAudioProvider(BaseAudioProvider):
             audio_codec=AudioCodecs(downloaded["acodec"]),
         )
 
+    def _extract_info(self, url: str, output_format: Format = None) -> dict[str, Any]:
+        with self._download_lock:
+            self.youtube_dl.params["format"] = self._format_selector(output_format)
+            return self.youtube_dl.extract_info(url, download=False)
+
+    async def stream(
+        self, result: AudioSearchResult, output_format: Format = None
+    ) -> AudioStream:
+        logger.info(
+            f"Starting stream for search result '{result.song.title}' with URL {result.download_url}"
+        )
+
+        await self.limiter.acquire_async()
+        info = await _run_in_loop(
+            self._extract_info,
+            {"url": result.download_url, "output_format": output_format},
+        )
+        if "url" not in info:
+            raise ValueError(
+                f"Format '{info.get('format_id')}' can't be streamed, it needs to be merged from many formats"
+            )
+
+        return AudioStream(
+            chunks=self._iter_chunks(
+                info["url"], info.get("http_headers") or {}, info.get("filesize")
+            ),
+            bitrate=info["abr"],
+            audio_codec=AudioCodecs(info["acodec"]),
+            container=info.get("ext"),
+        )
+
+    async def _iter_chunks(
+        self, url: str, headers: dict[str, str], size: int | None
+    ) -> AsyncIterator[bytes]:
+        timeout = aiohttp.ClientTimeout(sock_connect=10, sock_read=30)
+        async with aiohttp.ClientSession(headers=headers, timeout=timeout) as session:
+            position = 0
+            while size is None or position < size:
+                end = position + self.stream_chunk_size - 1
+                await self.limiter.acquire_async()
+                async with session.get(
+                    url, headers={"Range": f"bytes={position}-{end}"}
+                ) as response:
+                    self.limiter.handle_response(
+                        response.status, response.headers.get("Retry-After")
+                    )
+                    response.raise_for_status()
+                    async for chunk in response.content.iter_chunked(64 * 1024):
+                        position += len(chunk)
+                        yield chunk
+
+                    if response.status != 206:
+                        # The server ignored the range and sent the whole file
+                        return
+                    content_range = response.headers.get("Content-Range", "")
+                    if size is None and "/" in content_range:
+                        total = content_range.rsplit("/", 1)[1]
+                        size = int(total) if total.isdigit() else None
+                    if size is None and position <= end:
+                        # Unknown size and a short range means the end of the file
+                        return
+
 
 def instance():
     return YouTubeMusicAudioProvider
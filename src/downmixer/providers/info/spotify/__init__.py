@@ -2,12 +2,19 @@ from __future__ import annotations
 
 import logging
 import re
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Any, Callable
 
 import spotipy
+from requests.adapters import HTTPAdapter
+from urllib3 import Retry
 
 from downmixer import utils
 from downmixer.library import Playlist
 from downmixer.providers import BaseInfoProvider, ResourceType
+from downmixer.providers.ratelimit import get_rate_limiter, RateLimitedSession
+from downmixer.utils.cache import PersistentCache
 from .library import SpotifySong, SpotifyPlaylist, SpotifyAlbum
 
 logger = logging.getLogger("downmixer").getChild(__name__)
@@ -20,21 +27,36 @@ resource_type_map = {
 }
 
 
-def _get_all(func, limit=50, *args, **kwargs):
-    counter = 0
-    next_url = ""
-    items = []
-
-    while next_url is not None:
-        results = func(*args, **kwargs, limit=limit, offset=limit * counter)
-        next_url = results["next"]
-        counter += 1
-        items += results["items"]
+def _get_all(func, limit=50, *args, max_workers: int = 8, **kwargs):
+    """Gets every item from a paginated Spotify endpoint. The first page gives the total amount of items, and the
+    remaining pages are then requested at the same time by up to `max_workers` threads. Requests still go through the
+    provider's rate limiter, since it's shared by the whole session."""
+    first_page = func(*args, **kwargs, limit=limit, offset=0)
+    items = list(first_page["items"])
+    if first_page["next"] is None:
+        return items
+
+    offsets = range(limit, first_page["total"], limit)
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(offsets))) as executor:
+        # map returns the pages in the order of their offsets, no matter which finishes first
+        pages = executor.map(
+            lambda offset: func(*args, **kwargs, limit=limit, offset=offset), offsets
+        )
+        for page in pages:
+            items += page["items"]
 
     return items
 
 
+def _bare_id(value: str) -> str:
+    """Returns only the ID part of a Spotify ID, URI or URL, so they can all be used as the same cache key."""
+    matches = re.search(r"(\w{20,24})(?:\?.*)?$", value)
+    return matches.group(1) if matches else value
+
+
 class SpotifyInfoProvider(BaseInfoProvider):
+    provider_name = "spotify"
+
     def __init__(self, options: dict = None):
         default_options = {
             "auth": {
@@ -44,10 +66,42 @@ class SpotifyInfoProvider(BaseInfoProvider):
         options = utils.merge_dicts_with_priority(default_options, options)
         super().__init__(options)
 
+        limiter = get_rate_limiter(self.provider_name, options, rate=10, burst=10)
+        session = RateLimitedSession(limiter)
+        # Same retries Spotipy uses by default, except for 429 responses - those pause the rate limiter instead of
+        # retrying right away
+        adapter = HTTPAdapter(
+            max_retries=Retry(
+                total=3,
+                connect=None,
+                read=False,
+                allowed_methods=frozenset(["GET", "POST", "PUT", "DELETE"]),
+                status=3,
+                backoff_factor=0.3,
+                status_forcelist=(500, 502, 503, 504),
+            )
+        )
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+
         # TODO: Manage auth properly
         self.client = spotipy.Spotify(
-            auth_manager=spotipy.SpotifyOAuth(**options["auth"])
+            auth_manager=spotipy.SpotifyOAuth(**options["auth"]),
+            requests_session=session,
+        )
+
+        # Metadata cache, only enabled if a path is given in the "cache" option
+        cache_options = utils.merge_dicts_with_priority(
+            options.get("cache") or {},
+            {"path": None, "ttl": 30 * 24 * 60 * 60, "user_ttl": 10 * 60},
         )
+        self.cache = (
+            PersistentCache(Path(cache_options["path"]), "spotify")
+            if cache_options["path"]
+            else None
+        )
+        self.cache_ttl = cache_options["ttl"]
+        self.cache_user_ttl = cache_options["user_ttl"]
 
         self.connected = True
 
@@ -76,41 +130,107 @@ class SpotifyInfoProvider(BaseInfoProvider):
 
         return False
 
+    def _cached(self, key: str, ttl: float, fetch: Callable[[], Any]) -> Any:
+        """Returns the API data stored under the key if it's newer than `ttl` seconds, otherwise calls `fetch` and
+        stores its result. Always calls `fetch` if the cache is disabled."""
+        if self.cache is None:
+            return fetch()
+
+        data = self.cache.get(key, ttl)
+        if data is None:
+            data = fetch()
+            self.cache.set(key, data)
+        else:
+            logger.debug(f"Using cached data for '{key}'")
+        return data
+
     def get_song(self, track_id: str) -> SpotifySong:
         super().get_song(track_id)
 
-        result = self.client.track(track_id)
+        result = self._cached(
+            f"track:{_bare_id(track_id)}",
+            self.cache_ttl,
+            lambda: self.client.track(track_id),
+        )
         return SpotifySong.from_provider(result)
 
-    def get_all_playlist_songs(self, playlist_id: str) -> list[SpotifySong]:
-        super().get_all_playlist_songs(playlist_id)
+    def get_all_playlist_songs(
+        self, playlist_id: str, snapshot_id: str = None
+    ) -> list[SpotifySong]:
+        super().get_all_playlist_songs(playlist_id, snapshot_id)
 
         if self.check_valid_url(playlist_id, [ResourceType.PLAYLIST]):
-            results = _get_all(
-                self.client.playlist_items, limit=50, playlist_id=playlist_id
-            )
+            results = self._get_playlist_items(playlist_id, snapshot_id)
             return SpotifySong.from_provider_list(results)
         else:
-            album_info = self.client.album(playlist_id)
-            results = _get_all(self.client.album_tracks, limit=50, album_id=playlist_id)
+            data = self._cached(
+                f"album:{_bare_id(playlist_id)}",
+                self.cache_ttl,
+                lambda: {
+                    "album": self.client.album(playlist_id),
+                    "tracks": _get_all(
+                        self.client.album_tracks, limit=50, album_id=playlist_id
+                    ),
+                },
+            )
             return SpotifySong.from_provider_list(
-                results, extra_data={"album": album_info}
+                data["tracks"], extra_data={"album": data["album"]}
             )
 
+    def _get_playlist_items(
+        self, playlist_id: str, snapshot_id: str = None
+    ) -> list[dict]:
+        """Returns the items of a playlist. If the cache is enabled, only the playlist's `snapshot_id` is requested
+        (unless it's given) when the playlist didn't change since it was cached."""
+        if self.cache is None:
+            return _get_all(
+                self.client.playlist_items, limit=50, playlist_id=playlist_id
+            )
+
+        key = f"playlist:{_bare_id(playlist_id)}"
+        if snapshot_id is None:
+            snapshot_id = self.get_playlist_snapshot(playlist_id)
+        cached = self.cache.get(key)
+        if cached is not None and cached["snapshot_id"] == snapshot_id:
+            logger.debug(f"Playlist '{playlist_id}' didn't change, using cached items")
+            return cached["items"]
+
+        items = _get_all(self.client.playlist_items, limit=50, playlist_id=playlist_id)
+        self.cache.set(key, {"snapshot_id": snapshot_id, "items": items})
+        return items
+
+    def get_playlist_snapshot(self, playlist_id: str) -> str | None:
+        if not self.check_valid_url(playlist_id, [ResourceType.PLAYLIST]):
+            # Albums don't have snapshots
+            return None
+        return self.client.playlist(playlist_id, fields="snapshot_id")["snapshot_id"]
+
     def get_all_user_playlists(self) -> list[SpotifyPlaylist]:
         super().get_all_user_playlists()
 
-        results = _get_all(self.client.current_user_playlists)
+        results = self._cached(
+            "user:playlists",
+            self.cache_user_ttl,
+            lambda: _get_all(self.client.current_user_playlists),
+        )
         return SpotifyPlaylist.from_provider_list(results)
 
     def get_all_user_albums(self) -> list[Playlist]:
         super().get_all_user_albums()
 
-        results = _get_all(self.client.current_user_saved_albums, limit=50)
+        results = self._cached(
+            "user:albums",
+            self.cache_user_ttl,
+            lambda: _get_all(self.client.current_user_saved_albums, limit=50),
+        )
         return SpotifyAlbum.from_provider_list(results)
 
     def get_all_user_songs(self) -> list[SpotifySong]:
         super().get_all_user_songs()
 
-        results = _get_all(self.client.current_user_saved_tracks, limit=50)
+        results = self._cached(
+            "user:songs",
+            self.cache_user_ttl,
+            lambda: _get_all(self.client.current_user_saved_tracks, limit=50),
+        )
         return SpotifySong.from_provider_list(results)
@@ -1,37 +1,58 @@
 from typing import Any
 
-from downmixer.library import Album, Artist, Song, Playlist
+from downmixer.library import (
+    Album,
+    Artist,
+    Song,
+    Playlist,
+    Interner,
+    intern_markets,
+)
+
+# Artists and albums are shared by every song that has them, so big libraries don't hold a copy for each song
+_artists = Interner()
+_albums = Interner()
 
 
 class SpotifyArtist(Artist):
+    __slots__ = ()
+
     @classmethod
     def from_provider(
         cls, data: dict[str, Any], extra_data: dict[str, Any] = None
     ) -> "SpotifyArtist":
-        return cls(
-            name=data["name"],
-            images=data["images"] if "images" in data.keys() else None,
-            # TODO: Test the data structure of genres from Spotify
-            genres=data["genres"] if "genres" in data.keys() else None,
-            id=data["uri"],
-            url=data["external_urls"]["spotify"],
+        return _artists.get(
+            data["uri"],
+            lambda: cls(
+                name=data["name"],
+                images=data["images"] if "images" in data.keys() else None,
+                # TODO: Test the data structure of genres from Spotify
+                genres=data["genres"] if "genres" in data.keys() else None,
+                id=data["uri"],
+                url=data["external_urls"]["spotify"],
+            ),
         )
 
 
 class SpotifyAlbum(Album):
+    __slots__ = ()
+
     @classmethod
     def from_provider(
         cls, data: dict[str, Any], extra_data: dict[str, Any] = None
     ) -> "SpotifyAlbum":
-        return cls(
-            available_markets=data["available_markets"],
-            name=data["name"],
-            artists=SpotifyArtist.from_provider_list(data["artists"]),
-            date=data["release_date"],
-            track_count=data["total_tracks"],
-            cover=(data["images"][0]["url"] if len(data["images"]) > 0 else None),
-            id=data["uri"],
-            url=data["external_urls"]["spotify"],
+        return _albums.get(
+            data["uri"],
+            lambda: cls(
+                available_markets=intern_markets(data["available_markets"]),
+                name=data["name"],
+                artists=SpotifyArtist.from_provider_list(data["artists"]),
+                date=data["release_date"],
+                track_count=data["total_tracks"],
+                cover=(data["images"][0]["url"] if len(data["images"]) > 0 else None),
+                id=data["uri"],
+                url=data["external_urls"]["spotify"],
+            ),
         )
 
     @classmethod
@@ -43,6 +64,8 @@ class SpotifyAlbum(Album):
 
 
 class SpotifySong(Song):
+    __slots__ = ()
+
     @classmethod
     def from_provider(
         cls, data: dict[str, Any], extra_data: dict[str, Any] = None
@@ -55,7 +78,7 @@ class SpotifySong(Song):
             album = None
 
         return cls(
-            available_markets=data["available_markets"],
+            available_markets=intern_markets(data["available_markets"]),
             name=data["name"],
             artists=SpotifyArtist.from_provider_list(data["artists"]),
             album=(SpotifyAlbum.from_provider(album) if album else None),
@@ -86,6 +109,8 @@ class SpotifySong(Song):
 
 
 class SpotifyPlaylist(Playlist):
+    __slots__ = ()
+
     @classmethod
     def from_provider(
         cls, data: dict[str, Any], extra_data: dict[str, Any] = None
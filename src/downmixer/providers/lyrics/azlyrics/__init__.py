@@ -1,11 +1,14 @@
+import asyncio
 from typing import Optional
 
-import requests
+import aiohttp
 from bs4 import BeautifulSoup, Comment, ResultSet
 
-from downmixer import matching
+from downmixer import matching, utils
 from downmixer.library import Song, Artist
+from downmixer.matching import MatchResult
 from downmixer.providers import BaseLyricsProvider, LyricsSearchResult
+from downmixer.providers.ratelimit import get_rate_limiter
 
 COPYRIGHT_DISCLAIMER = (
     "Usage of azlyrics.com content by any third-party lyrics provider is prohibited by our "
@@ -15,8 +18,18 @@ COPYRIGHT_DISCLAIMER = (
 # TODO: Remove AZLyrics and add Genius provider
 
 
+def song_from_azlyrics(result: ResultSet) -> Song:
+    """Create a Song instance with the name, artist and lyrics page URL of a search result from AZLyrics."""
+    strings = result[0].find_all("b")
+    return Song(
+        name=strings[0].text[1:-1],
+        artists=[Artist(name=strings[1].text)],
+        url=result[0]["href"],
+    )
+
+
 def search_result_from_azlyrics(
-    result: ResultSet, original_song: Song
+    result: ResultSet, original_song: Song, match: MatchResult = None
 ) -> LyricsSearchResult:
     """Create a LyricsSearchResult instance from a
     [Beautiful Soup 4 `ResultSet`](https://www.crummy.com/software/BeautifulSoup/bs4/doc/#find-all) from AZLyrics.
@@ -24,21 +37,23 @@ def search_result_from_azlyrics(
     Args:
         result (bs4.ResultSet):
         original_song (Song): Instance of a song from Spotify that will be compared against this search result.
+        match (MatchResult, optional): Match between the original song and the result, if it was already calculated.
 
     Returns:
         LyricsSearchResult from AZLyrics.
     """
-    strings = result[0].find_all("b")
-    name = strings[0].text[1:-1]
-    artist = strings[1].text
+    return _search_result(song_from_azlyrics(result), original_song, match)
 
-    result_song = Song(name=name, artists=[Artist(name=artist)])
+
+def _search_result(
+    result_song: Song, original_song: Song, match: MatchResult = None
+) -> LyricsSearchResult:
     return LyricsSearchResult(
         provider="azlyrics",
-        match=matching.match(original_song, result_song),
-        name=name,
-        artist=artist,
-        url=result[0]["href"],
+        match=match or matching.match(original_song, result_song),
+        name=result_song.name,
+        artist=result_song.artists[0].name,
+        url=result_song.url,
     )
 
 
@@ -46,8 +61,10 @@ class AZLyricsProvider(BaseLyricsProvider):
     provider_name = "azlyrics"
 
     def __init__(self, options: dict = None):
-        super().__init__({})
-        headers = {
+        default_options = {"timeout": 30, "connect_timeout": 10, "connections": 10}
+        options = utils.merge_dicts_with_priority(default_options, options)
+        super().__init__(options)
+        self.headers = {
             "Connection": "keep-alive",
             "Pragma": "no-cache",
             "Cache-Control": "no-cache",
@@ -61,20 +78,72 @@ class AZLyricsProvider(BaseLyricsProvider):
             "Accept-Language": "en-US;q=0.8,en;q=0.7",
         }
 
-        self.session = requests.Session()
-        self.session.headers.update(headers)
-
-        resp = self.session.get("https://www.azlyrics.com/geo.js")
-
-        js_code = resp.text
+        # AZLyrics bans IPs that send too many requests, keep it slow by default
+        self.limiter = get_rate_limiter(self.provider_name, options, rate=1, burst=2)
+
+        # aiohttp sessions belong to the event loop they're created in, so it's only created on the first request
+        self.session: Optional[aiohttp.ClientSession] = None
+        self.x_code: Optional[str] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._x_code_task: Optional[asyncio.Future] = None
+
+    async def _get_session(self) -> aiohttp.ClientSession:
+        """Returns the session shared by every request of this provider, creating it if there is none for the
+        running event loop. Also gets the `x` code AZLyrics needs for searches, only once for all concurrent
+        calls."""
+        loop = asyncio.get_running_loop()
+        if self.session is None or self.session.closed or self._loop is not loop:
+            self._loop = loop
+            self._x_code_task = None
+            self.session = aiohttp.ClientSession(
+                headers=self.headers,
+                connector=aiohttp.TCPConnector(
+                    limit=self.options["connections"], keepalive_timeout=30
+                ),
+                timeout=aiohttp.ClientTimeout(
+                    total=self.options["timeout"],
+                    connect=self.options["connect_timeout"],
+                ),
+            )
+
+        session = self.session
+        if self.x_code is None:
+            if self._x_code_task is None:
+                self._x_code_task = asyncio.ensure_future(self._get_x_code(session))
+            try:
+                # Shielded so a cancelled search doesn't cancel the request for every other search waiting on it
+                self.x_code = await asyncio.shield(self._x_code_task)
+            except Exception:
+                self._x_code_task = None
+                raise
+
+        return session
+
+    async def _get_x_code(self, session: aiohttp.ClientSession) -> str:
+        js_code = await self._get(session, "https://www.azlyrics.com/geo.js")
         start_index = js_code.find('value"') + 9
         end_index = js_code[start_index:].find('");')
-
-        self.x_code = js_code[start_index : start_index + end_index]
+        return js_code[start_index : start_index + end_index]
+
+    async def _get(
+        self, session: aiohttp.ClientSession, url: str, params: dict = None
+    ) -> str:
+        await self.limiter.acquire_async()
+        async with session.get(url, params=params) as response:
+            self.limiter.handle_response(
+                response.status, response.headers.get("Retry-After")
+            )
+            response.raise_for_status()
+            return await response.text()
+
+    async def close(self):
+        if self.session is not None and not self.session.closed:
+            await self.session.close()
 
     async def get_lyrics(self, search_result: LyricsSearchResult) -> Optional[str]:
-        response = self.session.get(search_result.url)
-        soup = BeautifulSoup(response.content, "html.parser")
+        session = await self._get_session()
+        content = await self._get(session, search_result.url)
+        soup = BeautifulSoup(content, "html.parser")
 
         div_tags = soup.find_all("div", class_=False, id_=False)
         for d in div_tags:
@@ -89,18 +158,18 @@ class AZLyricsProvider(BaseLyricsProvider):
         return None
 
     async def search(self, song: Song) -> Optional[list[LyricsSearchResult]]:
+        session = await self._get_session()
         params = {"q": song.full_title, "x": self.x_code, "w": "songs"}
-
-        response = self.session.get(
-            "https://search.azlyrics.com/search.php", params=params
+        content = await self._get(
+            session, "https://search.azlyrics.com/search.php", params=params
         )
-        soup = BeautifulSoup(response.content, "html.parser")
+        soup = BeautifulSoup(content, "html.parser")
 
         td_tags = soup.find_all("td")
         if len(td_tags) == 0:
             return None
 
-        results: list[LyricsSearchResult] = []
+        result_sets: list[ResultSet] = []
         result_list = [x.find_all("a", href=True) for x in td_tags]
         for r in result_list:
             if len(r) == 0:
@@ -109,11 +178,15 @@ class AZLyricsProvider(BaseLyricsProvider):
             elif r[0].has_attr("class") and "btn" in r[0]["class"]:
                 continue
             else:
-                results.append(search_result_from_azlyrics(r, song))
-
-        ordered_results = sorted(results, reverse=True, key=lambda x: x.match.sum)
-
-        return ordered_results
+                result_sets.append(r)
+
+        # Each song keeps the URL of its lyrics page, so results are only parsed once. They're scored all at once,
+        # and come back already ordered by match.
+        result_songs = [song_from_azlyrics(r) for r in result_sets]
+        return [
+            _search_result(x, song, match)
+            for x, match in matching.match_many(song, result_songs)
+        ]
 
 
 def instance():
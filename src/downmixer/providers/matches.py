@@ -0,0 +1,156 @@
+"""Persistent store of the audio search result chosen for each song, so songs matched before skip searching."""
+
+from __future__ import annotations
+
+import json
+import logging
+from pathlib import Path
+from typing import Any, Optional
+
+from downmixer.library import Song, Artist, Album
+from downmixer.matching import MatchResult
+from downmixer.providers import AudioSearchResult
+from downmixer.utils.cache import PersistentCache
+
+logger = logging.getLogger("downmixer").getChild(__name__)
+
+
+def _result_to_dict(result: AudioSearchResult) -> dict[str, Any]:
+    result_song = result._result_song
+    return {
+        "provider": result.provider,
+        "download_url": result.download_url,
+        "match": {
+            "method": result.match.method,
+            "name_match": result.match.name_match,
+            "artists_match": [[a.name, v] for a, v in result.match.artists_match],
+            "album_match": result.match.album_match,
+            "length_match": result.match.length_match,
+        },
+        "result_song": {
+            "name": result_song.name,
+            "artists": [x.name for x in result_song.artists],
+            "album": result_song.album.name if result_song.album else None,
+            "duration": result_song.duration,
+            "url": result_song.url,
+        },
+    }
+
+
+def _result_from_dict(data: dict[str, Any], original_song: Song) -> AudioSearchResult:
+    match = data["match"]
+    result_song = data["result_song"]
+    return AudioSearchResult(
+        provider=data["provider"],
+        match=MatchResult(
+            method=match["method"],
+            name_match=match["name_match"],
+            artists_match=[(Artist(name=a), v) for a, v in match["artists_match"]],
+            album_match=match["album_match"],
+            length_match=match["length_match"],
+        ),
+        download_url=data["download_url"],
+        _original_song=original_song,
+        _result_song=Song(
+            name=result_song["name"],
+            artists=[Artist(name=x) for x in result_song["artists"]],
+            album=Album(name=result_song["album"]) if result_song["album"] else None,
+            duration=result_song["duration"],
+            url=result_song["url"],
+        ),
+    )
+
+
+class MatchStore:
+    def __init__(self, path: Path, ttl: float = 30 * 24 * 60 * 60):
+        """Maps songs, by their info provider ID and ISRC, to the `AudioSearchResult` chosen for them by each audio
+        provider. Stored in an SQLite database, so matches can be reused between runs, and can be exported to and
+        imported from JSON to share them between machines.
+
+        Args:
+            path (Path): Path of the database file.
+            ttl (float): Seconds after which a match is ignored and the song is searched again. Defaults to 30 days.
+        """
+        self.ttl = ttl
+        self._cache = PersistentCache(path, "matches")
+
+    @staticmethod
+    def _keys(song: Song, provider: str) -> list[str]:
+        keys = []
+        if song.id:
+            keys.append(f"{provider}:id:{song.id}")
+        if song.isrc:
+            keys.append(f"{provider}:isrc:{song.isrc}")
+        return keys
+
+    def get(self, song: Song, provider: str) -> Optional[AudioSearchResult]:
+        """Returns the result previously chosen for the song by the audio provider, looking it up first by ID and
+        then by ISRC.
+
+        Args:
+            song (Song): Song from the info provider.
+            provider (str): Name of the audio provider, usually its `provider_name`.
+
+        Returns:
+            The stored `AudioSearchResult`, or None if the song wasn't matched before or the match expired.
+        """
+        for key in self._keys(song, provider):
+            data = self._cache.get(key, self.ttl)
+            if data is not None:
+                logger.debug(f"Found stored match for '{song.title}' with key '{key}'")
+                return _result_from_dict(data, song)
+        return None
+
+    def put(self, song: Song, provider: str, result: AudioSearchResult):
+        """Stores the result chosen for the song by the audio provider, under both its ID and ISRC."""
+        data = _result_to_dict(result)
+        for key in self._keys(song, provider):
+            self._cache.set(key, data)
+
+    def invalidate(self, song: Song = None, provider: str = None):
+        """Removes stored matches, so they're searched again.
+
+        Args:
+            song (Song, optional): Only remove the matches of this song.
+            provider (str, optional): Only remove the matches from this audio provider.
+
+        If neither is given, every match is removed.
+        """
+        if song is not None:
+            providers = (
+                [provider]
+                if provider is not None
+                else {key.split(":", 1)[0] for key, _, _ in self._cache.items()}
+            )
+            for p in providers:
+                for key in self._keys(song, p):
+                    self._cache.delete(key)
+        elif provider is not None:
+            self._cache.delete_prefix(f"{provider}:")
+        else:
+            self._cache.clear()
+
+    def export_json(self, path: Path):
+        """Writes every stored match to a JSON file, to be imported on another machine with `import_json`."""
+        entries = [
+            {"key": key, "value": value, "stored_at": stored_at}
+            for key, value, stored_at in self._cache.items()
+        ]
+        Path(path).write_text(json.dumps(entries), encoding="utf-8")
+        logger.info(f"Exported {len(entries)} matches to '{path}'")
+
+    def import_json(self, path: Path):
+        """Reads matches from a JSON file made with `export_json`. Existing matches are only replaced by newer
+        ones."""
+        entries = json.loads(Path(path).read_text(encoding="utf-8"))
+        existing = {key: stored_at for key, _, stored_at in self._cache.items()}
+
+        imported = 0
+        for entry in entries:
+            if entry["stored_at"] > existing.get(entry["key"], 0):
+                self._cache.set(entry["key"], entry["value"], entry["stored_at"])
+                imported += 1
+        logger.info(f"Imported {imported} of {len(entries)} matches from '{path}'")
+
+    def close(self):
+        self._cache.close()
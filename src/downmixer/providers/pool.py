@@ -0,0 +1,68 @@
+"""Pool of provider instances that can be reused between songs instead of initializing a new one every time."""
+
+from __future__ import annotations
+
+import asyncio
+import contextlib
+import logging
+from typing import Type, TypeVar, Generic, AsyncIterator
+
+logger = logging.getLogger("downmixer").getChild(__name__)
+
+T = TypeVar("T")
+
+
+class ProviderPool(Generic[T]):
+    def __init__(self, provider_class: Type[T], options: dict = None, size: int = 3):
+        """Hands out warm provider instances, one per concurrent worker, and takes them back after use. Instances
+        are created lazily (outside the event loop, since initializing a provider is usually blocking) up to `size`
+        and kept for the lifetime of the pool.
+
+        Args:
+            provider_class (Type): Provider class to instantiate, for example a `BaseAudioProvider` child class.
+            options (dict, optional): Options passed to every instance of the provider.
+            size (int): Maximum amount of instances, which should be the amount of workers using the pool.
+        """
+        self.provider_class = provider_class
+        self.options = options
+        self.size = max(size, 1)
+
+        self._created = 0
+        self._idle: asyncio.Queue | None = None
+
+    async def acquire(self) -> T:
+        """Returns an idle instance, creating a new one if none are available and the pool isn't full. Waits for an
+        instance to be released otherwise. Every acquired instance must be given back with `release`.
+        """
+        if self._idle is None:
+            self._idle = asyncio.Queue()
+
+        if self._idle.empty() and self._created < self.size:
+            self._created += 1
+            try:
+                loop = asyncio.get_running_loop()
+                instance = await loop.run_in_executor(
+                    None, self.provider_class, self.options
+                )
+            except BaseException:
+                self._created -= 1
+                raise
+            logger.debug(
+                f"Created {self.provider_class.__name__} instance {self._created} of {self.size}"
+            )
+            return instance
+
+        return await self._idle.get()
+
+    def release(self, instance: T):
+        """Gives an instance back to the pool so other workers can use it."""
+        self._idle.put_nowait(instance)
+
+    @contextlib.asynccontextmanager
+    async def instance(self) -> AsyncIterator[T]:
+        """Context manager that acquires an instance and releases it when exiting."""
+        provider = await self.acquire()
+        try:
+            yield provider
+        finally:
+            self.release(provider)
@@ -0,0 +1,168 @@
+"""Token bucket rate limiters shared by every request a provider makes, so concurrent tasks and pooled instances
+together stay under the rate a service allows."""
+
+from __future__ import annotations
+
+import asyncio
+import functools
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable
+
+import requests
+
+from downmixer import utils
+
+logger = logging.getLogger("downmixer").getChild(__name__)
+
+_limiters: dict[str, "RateLimiter"] = {}
+_limiters_lock = threading.Lock()
+
+# Threads of synchronous calls that send rate limited requests, kept apart from the event loop's default executor so
+# threads sleeping in `RateLimiter.acquire` don't hold up downloads, covers and tagging
+_request_executor = ThreadPoolExecutor(thread_name_prefix="downmixer-requests")
+
+
+class RateLimiter:
+    def __init__(self, name: str, rate: float, burst: int = 1, pause: float = 5.0):
+        """Token bucket that lets through `rate` requests per second on average, and up to `burst` requests at once
+        after being idle. Requests that don't have a token wait their turn in the order they asked for it. Can be
+        used both from threads (`acquire`) and from the event loop (`acquire_async`).
+
+        Args:
+            name (str): Name of the limiter, used for logging.
+            rate (float): Average amount of requests per second.
+            burst (int): Maximum amount of tokens the bucket can hold.
+            pause (float): Seconds to pause every request after a `429 Too Many Requests` response with no
+                `Retry-After` header.
+        """
+        self.name = name
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self.pause_time = pause
+
+        self._tokens = float(self.burst)
+        # Time the tokens were counted at. Set in the future while paused, since no tokens are added until then
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self, now: float):
+        if now > self._updated:
+            self._tokens = min(
+                self.burst, self._tokens + (now - self._updated) * self.rate
+            )
+            self._updated = now
+
+    def _reserve(self) -> float:
+        """Takes a token from the bucket, going into debt if there are none, and returns how many seconds the caller
+        needs to wait before using it."""
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            self._tokens -= 1
+
+            wait = -self._tokens / self.rate if self._tokens < 0 else 0.0
+            # Counted from the end of the pause, if there's one, so waiters keep being spread out at the rate
+            return self._updated - now + wait
+
+    def acquire(self):
+        """Blocks the current thread until a request can be sent. Threads calling it should come from `run_blocking`,
+        not the event loop's default executor."""
+        wait = self._reserve()
+        if wait > 0:
+            time.sleep(wait)
+
+    async def acquire_async(self):
+        """Waits without blocking the event loop until a request can be sent."""
+        wait = self._reserve()
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+    def pause(self, seconds: float | None = None):
+        """Stops every request for the amount of seconds given, or `pause_time` if None. Used when the service
+        responds with `429 Too Many Requests`. Requests waiting for the pause are let through one at a time at the
+        limiter's rate once it ends, instead of all at once.
+        """
+        if seconds is None:
+            seconds = self.pause_time
+
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            if now + seconds > self._updated:
+                self._updated = now + seconds
+                # No burst after a pause, only the token of the first request
+                self._tokens = min(self._tokens, 1.0)
+        logger.warning(
+            f"Rate limited by '{self.name}', pausing requests for {seconds:.1f} seconds"
+        )
+
+    def handle_response(self, status: int, retry_after: str | None):
+        """Pauses the limiter if the response status and `Retry-After` header value given mean the service is
+        rate limiting us."""
+        if status == 429:
+            self.pause(utils.parse_retry_after(retry_after))
+
+
+async def run_blocking(func: Callable, *args, **kwargs) -> Any:
+    """Runs a synchronous function that sends rate limited requests (and so may block in `RateLimiter.acquire`) in
+    a thread pool of its own, without blocking the event loop.
+
+    Args:
+        func (Callable): Function to call.
+
+    Returns:
+        Whatever `func` returns.
+    """
+    return await asyncio.get_running_loop().run_in_executor(
+        _request_executor, functools.partial(func, *args, **kwargs)
+    )
+
+
+def get_rate_limiter(
+    name: str, options: dict | None, rate: float, burst: int = 1
+) -> RateLimiter:
+    """Returns the rate limiter shared by every instance of a provider, creating it on the first call. The rate can
+    be configured through the `rate_limit` key of the provider's options, for example
+    `{"rate_limit": {"rate": 2, "burst": 5}}`.
+
+    Args:
+        name (str): Name of the provider, usually its `provider_name`.
+        options (dict, optional): Options dictionary of the provider.
+        rate (float): Default amount of requests per second.
+        burst (int): Default maximum amount of requests at once.
+
+    Returns:
+        The shared `RateLimiter` for the provider.
+    """
+    with _limiters_lock:
+        if name not in _limiters:
+            limiter_options = utils.merge_dicts_with_priority(
+                (options or {}).get("rate_limit") or {},
+                {"rate": rate, "burst": burst},
+            )
+            _limiters[name] = RateLimiter(name, **limiter_options)
+            logger.debug(f"Created rate limiter for '{name}': {limiter_options}")
+        return _limiters[name]
+
+
+class RateLimitedSession(requests.Session):
+    def __init__(self, limiter: RateLimiter):
+        """A `requests.Session` that sends every request through a `RateLimiter` and pauses it when the service
+        answers with `429 Too Many Requests`.
+
+        Args:
+            limiter (RateLimiter): Rate limiter to use.
+        """
+        super().__init__()
+        self.limiter = limiter
+
+    def request(self, method, url, *args, **kwargs) -> requests.Response:
+        self.limiter.acquire()
+        response = super().request(method, url, *args, **kwargs)
+        self.limiter.handle_response(
+            response.status_code, response.headers.get("Retry-After")
+        )
+        return response
@@ -1,5 +1,8 @@
 from __future__ import annotations
 
+import datetime
+import email.utils
+
 
 def merge_dicts_with_priority(dict1: dict, dict2: dict | None) -> dict:
     """Merges two dictionaries with priority to `dict1`.
@@ -29,3 +32,31 @@ def merge_dicts_with_priority(dict1: dict, dict2: dict | None) -> dict:
                 new_dict[key] = value
 
     return new_dict
+
+
+def parse_retry_after(value: str | None) -> float | None:
+    """Parses the value of a `Retry-After` HTTP header, which can either be an amount of seconds or an HTTP date.
+
+    Args:
+        value (str, optional): Value of the header.
+
+    Returns:
+        float: Amount of seconds to wait, or None if the value is missing or invalid.
+    """
+    if value is None:
+        return None
+
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+
+    try:
+        date = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if date.tzinfo is None:
+        date = date.replace(tzinfo=datetime.timezone.utc)
+    return max(
+        (date - datetime.datetime.now(datetime.timezone.utc)).total_seconds(), 0.0
+    )
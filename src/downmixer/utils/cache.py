@@ -0,0 +1,94 @@
+"""Simple persistent key-value cache backed by SQLite, for data that should survive between runs."""
+
+from __future__ import annotations
+
+import json
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import Any, Optional, Iterator
+
+
+class PersistentCache:
+    def __init__(self, path: Path, table: str = "cache"):
+        """Stores JSON-serializable values by key in an SQLite database, along with the time they were stored. Can
+        be safely shared between threads.
+
+        Args:
+            path (Path): Path of the database file. Created if it doesn't exist.
+            table (str): Name of the table, so many caches can share the same file.
+        """
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.table = table
+
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(self.path, check_same_thread=False)
+        with self._connection:
+            self._connection.execute(
+                f"CREATE TABLE IF NOT EXISTS {self.table} "
+                "(key TEXT PRIMARY KEY, value TEXT NOT NULL, stored_at REAL NOT NULL)"
+            )
+
+    def get(self, key: str, ttl: float = None) -> Optional[Any]:
+        """Returns the value stored under the key, or None if there is none or it's older than `ttl` seconds.
+
+        Args:
+            key (str): Key of the value.
+            ttl (float, optional): Maximum age of the value in seconds. Values never expire if None.
+        """
+        with self._lock:
+            row = self._connection.execute(
+                f"SELECT value, stored_at FROM {self.table} WHERE key = ?", (key,)
+            ).fetchone()
+
+        if row is None:
+            return None
+        if ttl is not None and time.time() - row[1] > ttl:
+            return None
+        return json.loads(row[0])
+
+    def set(self, key: str, value: Any, stored_at: float = None):
+        """Stores a value under the key, replacing any previous value.
+
+        Args:
+            key (str): Key of the value.
+            value (Any): JSON-serializable value.
+            stored_at (float, optional): Timestamp to store the value with. Defaults to now.
+        """
+        with self._lock, self._connection:
+            self._connection.execute(
+                f"INSERT OR REPLACE INTO {self.table} VALUES (?, ?, ?)",
+                (key, json.dumps(value), stored_at or time.time()),
+            )
+
+    def delete(self, key: str):
+        with self._lock, self._connection:
+            self._connection.execute(f"DELETE FROM {self.table} WHERE key = ?", (key,))
+
+    def delete_prefix(self, prefix: str):
+        """Deletes every key starting with the prefix given."""
+        escaped = prefix.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+        with self._lock, self._connection:
+            self._connection.execute(
+                f"DELETE FROM {self.table} WHERE key LIKE ? ESCAPE '\\'",
+                (escaped + "%",),
+            )
+
+    def clear(self):
+        with self._lock, self._connection:
+            self._connection.execute(f"DELETE FROM {self.table}")
+
+    def items(self) -> Iterator[tuple[str, Any, float]]:
+        """Iterates over all entries as `(key, value, stored_at)` tuples."""
+        with self._lock:
+            rows = self._connection.execute(
+                f"SELECT key, value, stored_at FROM {self.table}"
+            ).fetchall()
+        for key, value, stored_at in rows:
+            yield key, json.loads(value), stored_at
+
+    def close(self):
+        with self._lock:
+            self._connection.close()